@@ -12,9 +12,39 @@ import sys
 from datetime import datetime
 import pprint
 import glob
+import signal
+import tempfile
+import time
 
 g_ini_file = ''
 
+# classification of each distinct 'service status' output we've seen:
+g_status_cache = dict()
+
+# -----------------------------------------------------------------------------
+# status_classify(work)
+# -----------------------------------------------------------------------------
+def status_classify(work):
+    """decide what a SysV 'service <svc> status' output means,
+       returns 'running', 'stopped', 'unknown', 'usage' or 'other'
+    """
+    if work in g_status_cache:
+        return g_status_cache[work]
+
+    x = work.split()
+    state = 'other'
+    if 'running...' in x:
+        state = 'running'
+    elif 'not' in x or 'stopped' in x:
+        state = 'stopped'
+    elif 'unknown' in x:
+        state = 'unknown'
+    elif 'Usage:' in x:
+        state = 'usage'
+
+    g_status_cache[work] = state
+    return state
+
 # -----------------------------------------------------------------------------
 # class Diag
 # -----------------------------------------------------------------------------
@@ -35,6 +65,9 @@ class Diag:
     os_version = ''
     services_list = []
     services = dict()
+    services_state = dict()
+    svc_timeout = 10.0
+    svc_workers = 8
     swapinfo = dict()
     sysname = ''
     uptime = ''
@@ -375,9 +408,54 @@ class Diag:
     # -----------------------------------------------------------------------------
     def services_load(self):
         """gather services info into services dictionary
+           runs up to svc_workers status scripts at a time,
+           kills any that take longer than svc_timeout seconds
         """
-        for svc in self.services_list:
-            self.services[svc] = self.service_check(svc)
+        waiting = list(self.services_list)
+        running = dict()    # svc: (process, output file, start time)
+
+        while len(waiting) > 0 or len(running) > 0:
+            # start as many as we're allowed:
+            while len(waiting) > 0 and len(running) < self.svc_workers:
+                svc = waiting.pop(0)
+                out = tempfile.TemporaryFile()
+                try:
+                    cmd = subprocess.Popen(['/sbin/service', svc, 'status'], \
+                            stdout=out, stderr=subprocess.STDOUT, \
+                            preexec_fn=os.setsid)
+                except OSError as error:
+                    out.close()
+                    self.services[svc] = str(error)
+                    self.services_state[svc] = 'unknown'
+                    continue
+                running[svc] = (cmd, out, time.time())
+
+            time.sleep(0.05)
+
+            # collect the ones that are done, kill the ones that are stuck:
+            for svc in list(running.keys()):
+                cmd, out, started = running[svc]
+                if cmd.poll() is None:
+                    if time.time() - started < self.svc_timeout:
+                        continue
+
+                    try:
+                        os.killpg(cmd.pid, signal.SIGKILL)
+                    except OSError as error:
+                        pass
+                    cmd.wait()
+                    work = svc + ' status timed out after ' + \
+                            '{0:.0f}'.format(self.svc_timeout) + 's'
+                    self.services[svc] = work
+                    self.services_state[svc] = 'unknown'
+                else:
+                    out.seek(0)
+                    work = out.read().decode('utf-8').rstrip()
+                    self.services[svc] = work
+                    self.services_state[svc] = status_classify(work)
+
+                out.close()
+                del running[svc]
 
     # -----------------------------------------------------------------------------
     # network_print()
@@ -411,6 +489,8 @@ class Diag:
                 network     - the network interface name, shown in ifconfig
                 disk        - mulitple entries for disks we track
                 service     - multiple entries for systemctl services
+                svc_workers - how many status scripts to run at once (default 8)
+                svc_timeout - seconds to let a status script run (default 10)
         """
 
         my_path = os.path.dirname(__file__) # find out just where we are
@@ -447,6 +527,12 @@ class Diag:
             if entrylist[0] == 'service':
                 self.services_list.append(entrylist[1])
 
+            if entrylist[0] == 'svc_workers':
+                self.svc_workers = int(entrylist[1])
+
+            if entrylist[0] == 'svc_timeout':
+                self.svc_timeout = float(entrylist[1])
+
             if entrylist[0] == 'disk':
                 self.disk_count += 1
                 self.disk_list.append(entrylist[1])
@@ -716,30 +802,32 @@ if __name__ == '__main__':
         notrunning = 0
         unknown = 0
 
-        for svc in diag.services:
-            x = diag.services[svc].split()
-            if len(x) > 0:
-                if 'running...' in x:
-                    print('    ', diag.services[svc])
-                    continue
+        for svc in diag.services_list:
+            if len(diag.services[svc]) == 0:
+                continue
 
-                if 'not' in x or 'stopped' in x:
-                    notrunning += 1
-                    print('    ', diag.services[svc])
-                    continue;
+            state = diag.services_state[svc]
+            if state == 'running':
+                print('    ', diag.services[svc])
+                continue
 
-                if 'unknown' in x:
-                    unknown += 1
-                    print('    ', diag.services[svc])
-                    continue;
+            if state == 'stopped':
+                notrunning += 1
+                print('    ', diag.services[svc])
+                continue;
 
-                if 'Usage:' in x:
-                    print('EDIT:', svc, 'in sysdiag.ini')
-                    continue
+            if state == 'unknown':
+                unknown += 1
+                print('    ', diag.services[svc])
+                continue;
 
-                print('     svc', svc, ':', diag.services[svc])
+            if state == 'usage':
+                print('EDIT:', svc, 'in sysdiag.ini')
                 continue
 
+            print('     svc', svc, ':', diag.services[svc])
+            continue
+
         if notrunning == 0:
             print('    all', str(running) + ' services are running')
         else:
@@ -12,37 +12,645 @@ import sys
 from datetime import datetime
 import pprint
 import glob
+import time
+import socket
+import fcntl
+import struct
+import re
+import threading
+import array
+import math
+import sqlite3
+import mmap
+import urllib.parse
+import json
+import http.server
+import asyncio
+import signal
+import stat
+import heapq
+import pwd
+import itertools
 
 g_ini_file = ''
 
+# in watch mode we keep /proc and /sys files open between samples:
+g_keep_open = False
+g_proc_fds = dict()
+
+# subsystems Diag knows how to collect, and the method that loads each:
+SUBSYSTEMS = ['disks', 'cpus', 'memory', 'network', 'netping', 'services', 'procs']
+LOADERS = {'disks': 'disks_load', 'cpus': 'cpus_load', 'memory': 'swapmem_load', \
+        'network': 'network_load', 'netping': 'netping_load', 'services': 'services_load', \
+        'procs': 'procs_load'}
+
+# which snapshot keys belong to each subsystem:
+SNAPSHOT_KEYS = {'disks': ['disks'], 'cpus': ['cpus'], 'memory': ['memory', 'swapinfo'], \
+        'network': ['network'], 'netping': ['netping', 'netping_lines'], \
+        'services': ['services', 'services_info'], 'procs': ['procs']}
+
+# where the query server listens unless --socket says otherwise:
+DEFAULT_SOCKET = '/run/sysdiag.sock'
+
+# default seconds each collector gets before we stop waiting on it,
+# override with timeout_<subsystem> in the .ini file:
+TIMEOUTS = {'disks': 10.0, 'cpus': 5.0, 'memory': 5.0, 'network': 5.0, \
+        'netping': 40.0, 'services': 30.0, 'procs': 10.0}
+
+# where the sample history database lives unless --db says otherwise:
+DEFAULT_DB = '/var/tmp/sysdiag.db'
+
+# rollup resolutions in seconds, and how long each one is kept:
+ROLLUPS = [60, 300, 3600]
+ROLLUP_KEEP = {60: 14 * 86400, 300: 90 * 86400, 3600: 730 * 86400}
+
+# segment files: header is magic, value scale, start time in ms
+SEGMENT_MAGIC = b'SDS1'
+SEGMENT_HEADER = struct.Struct('<4sIq')
+
+# metrics with fractional values, stored in segments as hundredths:
+SEGMENT_SCALED = ('.usep', '.busy', '.iowait', '.steal', '.rtt', \
+        '.iops', '.mbps', '.await', '.util')
+
+# shared-memory snapshot: magic, layout version, sequence number,
+# timestamp, payload length, then the payload (compact json)
+DEFAULT_SHM = '/dev/shm/sysdiag'
+SHM_MAGIC = b'SDSH'
+SHM_HEADER = struct.Struct('<4sIQdI4x')
+SHM_SIZE = 1024 * 1024
+
+# round trip time in ping output:
+PING_RTT = re.compile(r'time[=<]([0-9.]+) ?ms')
+
+# unit properties we ask systemd for:
+SYSTEMD_PROPS = ['Id', 'LoadState', 'ActiveState', 'SubState', 'MainPID', \
+        'MemoryCurrent', 'NRestarts']
+
+# sysfs statistics we read for each network interface:
+NET_COUNTERS = ['rx_bytes', 'tx_bytes', 'rx_packets', 'tx_packets', \
+        'rx_errors', 'rx_dropped', 'rx_fifo_errors', 'rx_frame_errors', \
+        'tx_errors', 'tx_dropped', 'tx_fifo_errors', 'tx_carrier_errors', \
+        'collisions']
+
+# clock ticks per second, the unit of the /proc/[pid]/stat CPU times:
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+# filesystems create_ini leaves out of the disk list, they have no
+# storage behind them (or, like squashfs, are always full):
+PSEUDO_FS = set(['tmpfs', 'devtmpfs', 'ramfs', 'proc', 'sysfs', 'devpts', 'cgroup', \
+        'cgroup2', 'pstore', 'bpf', 'debugfs', 'tracefs', 'securityfs', 'configfs', \
+        'fusectl', 'hugetlbfs', 'mqueue', 'autofs', 'binfmt_misc', 'rpc_pipefs', \
+        'nsfs', 'efivarfs', 'selinuxfs', 'squashfs', 'nfsd', 'fuse.gvfsd-fuse', \
+        'fuse.portal'])
+
+# where create_ini looks for enabled services, and what it leaves out:
+SYSTEMD_WANTS = '/etc/systemd/system/*.wants/*.service'
+SYSV_RC_DIRS = ['/etc/rc3.d', '/etc/rc.d/rc3.d']
+SYSV_SKIP = set(['README', 'functions', 'rc', 'rcS', 'rc.local', 'halt', 'killall', \
+        'single', 'skeleton', 'netconsole'])
+VIYA_UNIT = re.compile(r'^sas-viya-.+-default(\.service)?$')
+VIYA_AGGREGATES = set(['sas-viya-all-services'])
+
+# -----------------------------------------------------------------------------
+# proc_read(path)
+# -----------------------------------------------------------------------------
+def proc_read(path):
+    """read a whole /proc or /sys file, return it as a string
+       with g_keep_open set the file stays open and is re-read with
+       pread() from offset 0, which makes the kernel regenerate it
+    """
+    if not g_keep_open:
+        with open(path, 'r') as inp:
+            return inp.read()
+
+    fd = g_proc_fds.get(path)
+    if fd is None:
+        fd = os.open(path, os.O_RDONLY)
+        g_proc_fds[path] = fd
+
+    chunks = []
+    offset = 0
+    try:
+        while True:
+            chunk = os.pread(fd, 65536, offset)
+            if len(chunk) == 0:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+    except OSError as error:
+        # interface went away or similar, start over next time:
+        del g_proc_fds[path]
+        os.close(fd)
+        raise
+
+    return b''.join(chunks).decode('utf-8')
+
+# -----------------------------------------------------------------------------
+# parse_duration(text)
+# -----------------------------------------------------------------------------
+def parse_duration(text):
+    """turn '90', '90s', '15m', '1h', '7d' or '2w' into seconds
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if text[-1:] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+# -----------------------------------------------------------------------------
+# mountinfo()
+# -----------------------------------------------------------------------------
+def mountinfo():
+    """parse /proc/self/mountinfo, returns a list of
+       {'mount', 'devno', 'fstype', 'source'} in mount order
+    """
+    mounts = []
+    for line in proc_read('/proc/self/mountinfo').splitlines():
+        parts = line.split()
+        if '-' not in parts:
+            continue
+        sep = parts.index('-', 6)
+
+        # spaces and such in mount points come through as octal escapes:
+        mount = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), parts[4])
+        mounts.append({'mount': mount, 'devno': parts[2], \
+                'fstype': parts[sep + 1], 'source': parts[sep + 2]})
+
+    return mounts
+
+# -----------------------------------------------------------------------------
+# class Ring
+# -----------------------------------------------------------------------------
+class Ring:
+    """Fixed-capacity ring buffer of numbers kept in a typed array,
+       oldest values are overwritten once it's full
+    """
+    # -----------------------------------------------------------------------------
+    # __init__(capacity, typecode)
+    # -----------------------------------------------------------------------------
+    def __init__(self, capacity, typecode='f', fill=0.0):
+        """typecode is an array module typecode, 'f' for 4-byte floats
+        """
+        self.capacity = capacity
+        self.data = array.array(typecode, [fill]) * capacity
+        self.count = 0
+        self.head = 0   # where the next value goes
+
+    # -----------------------------------------------------------------------------
+    # append(value)
+    # -----------------------------------------------------------------------------
+    def append(self, value):
+        """add a value, O(1)
+        """
+        self.data[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    # -----------------------------------------------------------------------------
+    # __len__()
+    # -----------------------------------------------------------------------------
+    def __len__(self):
+        return self.count
+
+    # -----------------------------------------------------------------------------
+    # __getitem__(index)
+    # -----------------------------------------------------------------------------
+    def __getitem__(self, index):
+        """index 0 is the oldest value still held
+        """
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError('Ring index out of range')
+        return self.data[(self.head - self.count + index) % self.capacity]
+
+    # -----------------------------------------------------------------------------
+    # slice(start, stop)
+    # -----------------------------------------------------------------------------
+    def slice(self, start, stop=None):
+        """values start..stop (oldest is 0) as an array, copied in at most two pieces
+        """
+        if stop is None or stop > self.count:
+            stop = self.count
+        if start >= stop:
+            return self.data[0:0]
+
+        first = (self.head - self.count + start) % self.capacity
+        last = first + (stop - start)
+        if last <= self.capacity:
+            return self.data[first:last]
+        return self.data[first:] + self.data[:last - self.capacity]
+
+# -----------------------------------------------------------------------------
+# class History
+# -----------------------------------------------------------------------------
+class History:
+    """In-memory history of Diag samples, one Ring per metric.
+       All the metrics share one ring of timestamps; values are 4-byte
+       floats, so a day of 1-second samples costs about 340K per metric.
+    """
+    # -----------------------------------------------------------------------------
+    # __init__(capacity)
+    # -----------------------------------------------------------------------------
+    def __init__(self, capacity):
+        """capacity is the number of samples to keep
+        """
+        self.capacity = capacity
+        self.ts = Ring(capacity, 'd')
+        self.metrics = dict()
+
+    # -----------------------------------------------------------------------------
+    # add(ts, samples)
+    # -----------------------------------------------------------------------------
+    def add(self, ts, samples):
+        """add one sample, a list of (metric, value) taken at time ts;
+           metrics missing from this sample get NaN
+        """
+        seen = set()
+        for metric, value in samples:
+            ring = self.metrics.get(metric)
+            if ring is None:
+                # new metric, pad it out so it lines up with the timestamps:
+                ring = Ring(self.capacity, 'f', float('nan'))
+                ring.count = len(self.ts)
+                ring.head = self.ts.head
+                self.metrics[metric] = ring
+            ring.append(value)
+            seen.add(metric)
+
+        for metric in self.metrics:
+            if metric not in seen:
+                self.metrics[metric].append(float('nan'))
+
+        self.ts.append(ts)
+
+    # -----------------------------------------------------------------------------
+    # since(metric, seconds)
+    # -----------------------------------------------------------------------------
+    def since(self, metric, seconds, now=None):
+        """the samples of a metric from the last so many seconds,
+           returns (timestamps, values) as arrays
+        """
+        if now is None:
+            now = time.time()
+
+        # binary search for the first timestamp we want:
+        lo = 0
+        hi = len(self.ts)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.ts[mid] < now - seconds:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        ring = self.metrics.get(metric)
+        if ring is None:
+            return self.ts.slice(0, 0), array.array('f')
+        return self.ts.slice(lo), ring.slice(lo)
+
+# -----------------------------------------------------------------------------
+# class HistoryStore
+# -----------------------------------------------------------------------------
+class HistoryStore:
+    """Sample history kept in a local SQLite database.
+       Rows are buffered and written in batches, one transaction each,
+       and every batch also prunes a chunk of rows older than keep seconds.
+       Each batch also updates min/max/sum/count rollups at every
+       resolution in ROLLUPS, so long ranges never touch the raw rows.
+    """
+    # -----------------------------------------------------------------------------
+    # __init__(path, keep)
+    # -----------------------------------------------------------------------------
+    def __init__(self, path=DEFAULT_DB, keep=7 * 86400, batch_rows=5000, batch_seconds=10.0, \
+            readonly=False):
+        """open (or create) the database at path,
+           readonly just opens an existing one for queries
+        """
+        self.keep = keep
+        self.batch_rows = batch_rows
+        self.batch_seconds = batch_seconds
+        self.pending = []
+        self.flushed = time.time()
+        self.rollups_pruned = 0
+
+        if readonly:
+            self.db = sqlite3.connect('file:' + urllib.parse.quote(path) + '?mode=ro', uri=True)
+            return
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS samples ' \
+                '(metric TEXT NOT NULL, host TEXT NOT NULL, ts REAL NOT NULL, value REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS samples_mht ON samples (metric, host, ts)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS rollups ' \
+                '(metric TEXT NOT NULL, host TEXT NOT NULL, res INTEGER NOT NULL, ' \
+                'bucket INTEGER NOT NULL, min REAL, max REAL, sum REAL, count INTEGER, ' \
+                'PRIMARY KEY (metric, host, res, bucket)) WITHOUT ROWID')
+        self.db.commit()
+
+    # -----------------------------------------------------------------------------
+    # add(host, ts, samples)
+    # -----------------------------------------------------------------------------
+    def add(self, host, ts, samples):
+        """queue one sample, a list of (metric, value), write when the batch is big enough
+        """
+        for metric, value in samples:
+            self.pending.append((metric, host, ts, value))
+
+        if len(self.pending) >= self.batch_rows \
+                or time.time() - self.flushed >= self.batch_seconds:
+            self.flush()
+
+    # -----------------------------------------------------------------------------
+    # flush()
+    # -----------------------------------------------------------------------------
+    def flush(self):
+        """write everything queued in one transaction, then prune a little
+        """
+        # fold the batch into per-bucket aggregates first:
+        rollups = dict()
+        for metric, host, ts, value in self.pending:
+            for res in ROLLUPS:
+                key = (metric, host, res, int(ts // res) * res)
+                agg = rollups.get(key)
+                if agg is None:
+                    rollups[key] = [value, value, value, 1]
+                else:
+                    agg[0] = min(agg[0], value)
+                    agg[1] = max(agg[1], value)
+                    agg[2] += value
+                    agg[3] += 1
+
+        with self.db:
+            self.db.executemany('INSERT INTO samples VALUES (?, ?, ?, ?)', self.pending)
+            self.db.executemany('INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?) ' \
+                    'ON CONFLICT (metric, host, res, bucket) DO UPDATE SET ' \
+                    'min = min(min, excluded.min), max = max(max, excluded.max), ' \
+                    'sum = sum + excluded.sum, count = count + excluded.count', \
+                    [k + tuple(v) for k, v in rollups.items()])
+        self.pending = []
+        self.flushed = time.time()
+        self.prune()
+
+    # -----------------------------------------------------------------------------
+    # prune(limit)
+    # -----------------------------------------------------------------------------
+    def prune(self, limit=10000):
+        """delete up to limit expired rows, returns how many went
+           rows go in roughly rowid (= time) order, so only the oldest limit
+           rowids are looked at, and nothing at all if the oldest row is current
+        """
+        pruned = 0
+        cutoff = time.time() - self.keep
+        oldest = self.db.execute('SELECT ts FROM samples ORDER BY rowid LIMIT 1').fetchone()
+        if oldest is not None and oldest[0] < cutoff:
+            with self.db:
+                cur = self.db.execute('DELETE FROM samples WHERE rowid IN ' \
+                        '(SELECT rowid FROM samples ORDER BY rowid LIMIT ?) AND ts < ?', \
+                        (limit, cutoff))
+            pruned = cur.rowcount
+
+        # the rollups are small and kept for a long time, hourly is plenty:
+        if time.time() - self.rollups_pruned >= 3600:
+            with self.db:
+                for res in ROLLUPS:
+                    self.db.execute('DELETE FROM rollups WHERE res = ? AND bucket < ?', \
+                            (res, time.time() - ROLLUP_KEEP[res]))
+            self.rollups_pruned = time.time()
+
+        return pruned
+
+    # -----------------------------------------------------------------------------
+    # query(metric, host, since)
+    # -----------------------------------------------------------------------------
+    def query(self, metric, host, since, until=None):
+        """rows of (ts, value) for a metric between since and until (default now)
+        """
+        if until is None:
+            until = time.time()
+        cur = self.db.execute('SELECT ts, value FROM samples ' \
+                'WHERE metric = ? AND host = ? AND ts >= ? AND ts <= ? ORDER BY ts', \
+                (metric, host, since, until))
+        return cur.fetchall()
+
+    # -----------------------------------------------------------------------------
+    # query_range(metric, host, since, until, max_points)
+    # -----------------------------------------------------------------------------
+    def query_range(self, metric, host, since, until=None, max_points=500):
+        """samples of a metric over a range, from the raw rows for short
+           ranges or else the finest rollup that needs no more than max_points
+           buckets (and still goes back far enough);
+           returns (resolution, [(ts, min, max, avg, count), ...]), resolution 0 for raw
+        """
+        if until is None:
+            until = time.time()
+        span = until - since
+
+        res = 0
+        if span > 7200 or since < time.time() - self.keep:
+            res = ROLLUPS[-1]
+            for r in ROLLUPS:
+                if span / r <= max_points and since >= time.time() - ROLLUP_KEEP[r]:
+                    res = r
+                    break
+
+        if res == 0:
+            rows = self.query(metric, host, since, until)
+            return res, [(ts, v, v, v, 1) for ts, v in rows]
+
+        cur = self.db.execute('SELECT bucket, min, max, sum / count, count FROM rollups ' \
+                'WHERE metric = ? AND host = ? AND res = ? AND bucket >= ? AND bucket <= ? ' \
+                'ORDER BY bucket', (metric, host, res, int(since // res) * res, until))
+        return res, cur.fetchall()
+
+    # -----------------------------------------------------------------------------
+    # close()
+    # -----------------------------------------------------------------------------
+    def close(self):
+        """write what's left and close the database
+        """
+        if len(self.pending) > 0:
+            self.flush()
+        self.db.close()
+
+# -----------------------------------------------------------------------------
+# varint_encode(n)
+# -----------------------------------------------------------------------------
+def varint_encode(n):
+    """zigzag-encode a signed integer as a varint, returns bytes
+    """
+    n = (n << 1) if n >= 0 else ((-n) << 1) - 1
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+# -----------------------------------------------------------------------------
+# varint_decode(buf, pos)
+# -----------------------------------------------------------------------------
+def varint_decode(buf, pos):
+    """decode one zigzag varint from buf at pos, returns (value, next pos)
+       raises IndexError if buf ends in the middle of it
+    """
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            break
+        shift += 7
+    return ((n >> 1) ^ -(n & 1)), pos
+
+# -----------------------------------------------------------------------------
+# class SegmentWriter
+# -----------------------------------------------------------------------------
+class SegmentWriter:
+    """Append-only compressed sample files, one directory per metric.
+       Each point is the delta-of-delta of its timestamp (ms) and the delta
+       of its scaled integer value, both as zigzag varints, so a steady
+       sample rate and a slow-moving value cost two or three bytes a point.
+       A new segment is started every segment_points points.
+    """
+    # -----------------------------------------------------------------------------
+    # __init__(directory, segment_points)
+    # -----------------------------------------------------------------------------
+    def __init__(self, directory, segment_points=86400):
+        """directory holds a subdirectory per metric
+        """
+        self.directory = directory
+        self.segment_points = segment_points
+        self.open = dict()  # metric: [file, scale, points, last ts, last delta, last value]
+
+    # -----------------------------------------------------------------------------
+    # add(ts, samples)
+    # -----------------------------------------------------------------------------
+    def add(self, ts, samples):
+        """append one sample, a list of (metric, value) taken at time ts,
+           flushed so readers (and a crash) see whole samples
+        """
+        ms = int(ts * 1000)
+        written = []
+        for metric, value in samples:
+            seg = self.open.get(metric)
+            if seg is None or seg[2] >= self.segment_points:
+                seg = self.start(metric, ms)
+
+            scaled = int(round(value * seg[1]))
+            delta = ms - seg[3]
+            seg[0].write(varint_encode(delta - seg[4]) + varint_encode(scaled - seg[5]))
+            seg[2] += 1
+            seg[3] = ms
+            seg[4] = delta
+            seg[5] = scaled
+            written.append(seg[0])
+
+        for out in written:
+            out.flush()
+
+    # -----------------------------------------------------------------------------
+    # start(metric, ms)
+    # -----------------------------------------------------------------------------
+    def start(self, metric, ms):
+        """close the metric's current segment, start a new one at ms
+        """
+        if metric in self.open:
+            self.open[metric][0].close()
+
+        scale = 100 if metric.endswith(SEGMENT_SCALED) else 1
+        metric_dir = os.path.join(self.directory, urllib.parse.quote(metric, safe=''))
+        os.makedirs(metric_dir, exist_ok=True)
+
+        out = open(os.path.join(metric_dir, '{:d}.seg'.format(ms)), 'ab')
+        out.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, scale, ms))
+        out.flush()
+        self.open[metric] = [out, scale, 0, ms, 0, 0]
+        return self.open[metric]
+
+    # -----------------------------------------------------------------------------
+    # close()
+    # -----------------------------------------------------------------------------
+    def close(self):
+        """flush and close all the open segments
+        """
+        for metric in self.open:
+            self.open[metric][0].close()
+        self.open = dict()
+
+# -----------------------------------------------------------------------------
+# segment_read(path, since, until)
+# -----------------------------------------------------------------------------
+def segment_read(path, since=0, until=None):
+    """stream (ts, value) pairs out of one segment file through mmap,
+       decoding only as far as until
+    """
+    with open(path, 'rb') as inp:
+        # a writer that has only just created it, nothing to read (or mmap):
+        if os.fstat(inp.fileno()).st_size < SEGMENT_HEADER.size:
+            return
+
+        with mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            magic, scale, ms = SEGMENT_HEADER.unpack_from(buf, 0)
+            if magic != SEGMENT_MAGIC:
+                return
+
+            pos = SEGMENT_HEADER.size
+            delta = 0
+            value = 0
+            while pos < len(buf):
+                try:
+                    dod, pos = varint_decode(buf, pos)
+                    dv, pos = varint_decode(buf, pos)
+                except IndexError as error:
+                    return  # last point only half written
+
+                delta += dod
+                ms += delta
+                value += dv
+                ts = ms / 1000.0
+                if until is not None and ts > until:
+                    return
+                if ts >= since:
+                    yield ts, value / float(scale)
+
+# -----------------------------------------------------------------------------
+# segments_read(directory, metric, since, until)
+# -----------------------------------------------------------------------------
+def segments_read(directory, metric, since=0, until=None):
+    """stream (ts, value) pairs for a metric across its segments,
+       skipping segments that end before since
+    """
+    metric_dir = os.path.join(directory, urllib.parse.quote(metric, safe=''))
+    try:
+        starts = sorted([int(x[:-4]) for x in os.listdir(metric_dir) if x.endswith('.seg')])
+    except (IOError, OSError) as error:
+        return
+
+    for i in range(len(starts)):
+        if i + 1 < len(starts) and starts[i + 1] / 1000.0 < since:
+            continue
+        if until is not None and starts[i] / 1000.0 > until:
+            break
+        path = os.path.join(metric_dir, '{:d}.seg'.format(starts[i]))
+        for point in segment_read(path, since, until):
+            yield point
+
 # -----------------------------------------------------------------------------
 # class Diag
 # -----------------------------------------------------------------------------
 class Diag:
     """Diagnostics class
     """
-    # instance variables:
-    cpu_count = 0
-    cpus = dict()
-    datestamp = ''
-    disk_list = []
-    disk_count = 0
-    disks = dict()
-    memory = dict()
-    network = dict()
-    net_interface = ''
-    netping_lines = []
-    os_version = ''
-    services_list = []
-    services = dict()
-    swapinfo = dict()
-    sysname = ''
-    uptime = ''
-
     # -----------------------------------------------------------------------------
     # humanize(number)
     # -----------------------------------------------------------------------------
-    def humanize(self, f):
+    @staticmethod
+    def humanize(f):
         """turn an integer into human-readable format
         """
         if f < 1024:
@@ -72,16 +680,235 @@ class Diag:
         usep = ((1.0 - (float(free) / float(size))) * 100.0) + 0.5
         return name, size, used, free, usep
 
+    # -----------------------------------------------------------------------------
+    # stale_load()
+    # -----------------------------------------------------------------------------
+    def stale_load(self):
+        """read the stale mount cache, returns {mount: when it went stale}
+           entries older than stale_ttl seconds are dropped
+        """
+        stale = dict()
+        try:
+            with open(self.stale_cache, 'r') as inp:
+                lines = inp.readlines()
+        except (IOError, OSError) as error:
+            return stale
+
+        now = time.time()
+        for line in lines:
+            parts = line.split()
+            if len(parts) != 2:
+                continue
+            try:
+                when = float(parts[0])
+            except ValueError as error:
+                continue
+            if now - when < self.stale_ttl:
+                stale[parts[1]] = when
+
+        return stale
+
+    # -----------------------------------------------------------------------------
+    # stale_save(stale)
+    # -----------------------------------------------------------------------------
+    def stale_save(self, stale):
+        """write the stale mount cache back out
+        """
+        try:
+            with open(self.stale_cache + '.tmp', 'w') as out:
+                for mount in stale:
+                    out.write('{:.0f} {}\n'.format(stale[mount], mount))
+            os.replace(self.stale_cache + '.tmp', self.stale_cache)
+        except (IOError, OSError) as error:
+            pass # not being able to cache isn't worth failing over
+
+    # -----------------------------------------------------------------------------
+    # disk_stat_worker(name, results)
+    # -----------------------------------------------------------------------------
+    def disk_stat_worker(self, name, results):
+        """run disk_stat in a thread, a hung statvfs only hangs this thread
+        """
+        try:
+            results[name] = self.disk_stat(name)
+        except (IOError, OSError, ZeroDivisionError) as error:
+            results[name] = error
+
+    # -----------------------------------------------------------------------------
+    # disk_devices(mounts, name)
+    # -----------------------------------------------------------------------------
+    def disk_devices(self, mounts, name):
+        """find the block device behind a disk entry,
+           returns (device name, [underlying devices]) or (None, [])
+           for things like NFS that have no block device
+        """
+        # the mount holding name is the longest one that's a prefix of it,
+        # if the same point is mounted twice the last one is on top;
+        # only string matching here, resolving symlinks in name would touch
+        # the filesystem and hang on a dead NFS server:
+        path = os.path.normpath(os.path.join('/', name))
+        devno = None
+        source = ''
+        longest = -1
+        for m in mounts:
+            mount = m['mount'].rstrip('/') + '/'
+            if (path + '/').startswith(mount) and len(mount) >= longest:
+                devno = m['devno']
+                source = m['source']
+                longest = len(mount)
+        if devno is None:
+            return None, []
+
+        # btrfs and friends report an anonymous device, go by the source:
+        if devno.startswith('0:') and source.startswith('/dev/'):
+            try:
+                rdev = os.stat(source).st_rdev
+                devno = str(os.major(rdev)) + ':' + str(os.minor(rdev))
+            except (IOError, OSError) as error:
+                return None, []
+
+        sysdir = '/sys/dev/block/' + devno
+        if not os.path.exists(sysdir):
+            return None, []
+
+        # device-mapper (LVM, multipath, crypt) devices sit on top of slaves:
+        slaves = []
+        todo = [os.path.realpath(sysdir)]
+        while len(todo) > 0:
+            for slave in sorted(glob.glob(todo.pop(0) + '/slaves/*')):
+                slaves.append(os.path.basename(slave))
+                todo.append(os.path.realpath(slave))
+
+        return os.path.basename(os.path.realpath(sysdir)), slaves
+
+    # -----------------------------------------------------------------------------
+    # diskstats()
+    # -----------------------------------------------------------------------------
+    def diskstats(self):
+        """read /proc/diskstats, returns (time, {device: [reads, read sectors,
+           read ms, writes, write sectors, write ms, io ms]})
+        """
+        stats = dict()
+        for line in proc_read('/proc/diskstats').splitlines():
+            p = line.split()
+            if len(p) < 14:
+                continue
+            stats[p[2]] = [int(p[3]), int(p[5]), int(p[6]), \
+                    int(p[7]), int(p[9]), int(p[10]), int(p[12])]
+
+        return time.time(), stats
+
+    # -----------------------------------------------------------------------------
+    # disk_io(device, before, after)
+    # -----------------------------------------------------------------------------
+    def disk_io(self, device, before, after):
+        """work out iostat-style numbers for a device between two diskstats reads
+        """
+        then, b = before
+        now, a = after
+        if device not in a or device not in b or now <= then:
+            return None
+
+        d = [x - y for x, y in zip(a[device], b[device])]
+        reads, rsect, rms, writes, wsect, wms, iotime = d
+        secs = now - then
+        ios = reads + writes
+
+        io = dict()
+        io['r/s']     = reads / secs
+        io['w/s']     = writes / secs
+        io['iops']    = ios / secs
+        io['rMB/s']   = rsect * 512 / secs / 1000000.0
+        io['wMB/s']   = wsect * 512 / secs / 1000000.0
+        io['MB/s']    = io['rMB/s'] + io['wMB/s']
+        io['await']   = (rms + wms) / float(ios) if ios > 0 else 0.0
+        io['%util']   = min(100.0 * iotime / (secs * 1000.0), 100.0)
+        return io
+
     # -----------------------------------------------------------------------------
     # disks_load(disk_list)
     # -----------------------------------------------------------------------------
     def disks_load(self):
         """create dictionary for the disks in disk_list
+           each statvfs gets disk_timeout seconds; a mount that doesn't answer
+           is marked stale and skipped for stale_ttl seconds, even across runs,
+           and for as long after that as its last statvfs is still hung
         """
+        # take the I/O baseline now, the statvfs calls cover most of the wait:
+        started = time.time()
+        io_before = self.diskstats_prev
+        if io_before is None:
+            io_before = self.diskstats()
+
+        stale = self.stale_load()
+        stale_count = len(stale)
+        results = dict()
+        workers = dict()
+
+        hung = set()
+        for disk in self.disk_list:
+            if disk in stale:
+                continue
+
+            # one thread stuck in the kernel per dead mount is enough:
+            stuck = self.disk_workers.get(disk)
+            if stuck is not None and stuck.is_alive():
+                hung.add(disk)
+                continue
+
+            worker = threading.Thread(target=self.disk_stat_worker, \
+                    args=(disk, results), name='statvfs ' + disk, daemon=True)
+            worker.start()
+            workers[disk] = worker
+            self.disk_workers[disk] = worker
+
+        deadline = time.time() + self.disk_timeout
+        for disk in workers:
+            workers[disk].join(max(deadline - time.time(), 0))
+
+        if self.diskstats_prev is None and time.time() < started + self.io_interval:
+            time.sleep(started + self.io_interval - time.time())
+        io_after = self.diskstats()
+        self.diskstats_prev = io_after
+        mounts = mountinfo()
+
+        disks = dict()
+        now = time.time()
         for disk in self.disk_list:
             td = dict()
-            td['name'], td['size'], td['used'], td['free'], td['usep'] = self.disk_stat(disk)
-            self.disks[td['name']] = td #[size, used, free, usep]
+            td['name'] = disk
+            td['stale'] = False
+            td['device'] = None
+            td['slaves'] = []
+            td['io'] = None
+
+            # stale or timed-out mounts get no device lookup, same as no statvfs:
+            if disk in results:
+                td['device'], td['slaves'] = self.disk_devices(mounts, disk)
+                if td['device'] is not None:
+                    td['io'] = self.disk_io(td['device'], io_before, io_after)
+
+            if disk in hung:
+                td['stale'] = True
+                td['error'] = 'stale, last statvfs still hung'
+                stale[disk] = now
+            elif disk in stale:
+                td['stale'] = True
+                td['error'] = 'stale, skipped (no response {:.0f}s ago)'.format(now - stale[disk])
+            elif disk not in results:
+                td['stale'] = True
+                td['error'] = 'stale, no response after {:g}s'.format(self.disk_timeout)
+                stale[disk] = now
+            elif isinstance(results[disk], Exception):
+                td['error'] = str(results[disk])
+            else:
+                td['name'], td['size'], td['used'], td['free'], td['usep'] = results[disk]
+
+            disks[disk] = td #[size, used, free, usep]
+
+        self.publish({'disks': disks})
+
+        if len(stale) != stale_count:
+            self.stale_save(stale)
 
     # -----------------------------------------------------------------------------
     # pretty-print the disk usage:
@@ -89,36 +916,94 @@ class Diag:
     def disk_print(self):
         """pretty-print the disk stats
         """
-        print('    filesystem:       size:   used:   free:  %use:')
+        self.need('disks')
+        if self.not_collected('disks'):
+            return
+
+        print('    filesystem:       size:   used:   free:  %use:   iops:   MB/s:  await: %util:')
         for index in self.disk_list:
             p = self.disks[index]
+            if 'error' in p:
+                print('    ' + index.ljust(16) + '  ' + p['error'])
+                continue
+
             x = index.ljust(16) + \
                     self.humanize(p['size']).rjust(7)+ \
                     self.humanize(p['used']).rjust(8)+ \
                     self.humanize(p['free']).rjust(8)+ \
                     '  ' + '{:3.1f}'.format(p['usep']).rjust(5)
+            if p['io'] is not None:
+                x += '{:.1f}'.format(p['io']['iops']).rjust(8) + \
+                        '{:.2f}'.format(p['io']['MB/s']).rjust(8) + \
+                        '{:.2f}'.format(p['io']['await']).rjust(8) + \
+                        '{:.1f}'.format(p['io']['%util']).rjust(7)
             print('    ' + x)
 
     # -----------------------------------------------------------------------------
-    # swapmem_load()
+    # meminfo()
     # -----------------------------------------------------------------------------
-    def swapmem_load(self):
-        """get memory and swap information
+    def meminfo(self):
+        """read /proc/meminfo into a dictionary,
+           sizes converted to bytes, page counts left alone
         """
-        work = subprocess.check_output(['/usr/bin/free', '-b'], \
-                stderr=subprocess.STDOUT)
-        work = work.decode('utf-8')
+        info = dict()
+        for line in proc_read('/proc/meminfo').splitlines():
+            parts = line.split()
+            if len(parts) < 2:
+                continue
 
-        work_strings = work.splitlines()
-        headings     = work_strings[0].split()
-        mem          = work_strings[1].split()
-        swap         = work_strings[2].split()
+            value = int(parts[1])
+            if len(parts) > 2 and parts[2] == 'kB':
+                value *= 1024
+            info[parts[0].rstrip(':')] = value
 
-        for i in range(1, len(headings) + 1):
-            self.memory[headings[i - 1]] = int(mem[i])
+        return info
 
-        for i in range(1, len(swap)):
-            self.swapinfo[headings[i - 1]] = int(swap[i])
+    # -----------------------------------------------------------------------------
+    # swapmem_load()
+    # -----------------------------------------------------------------------------
+    def swapmem_load(self):
+        """get memory and swap information
+           same numbers /usr/bin/free shows, worked out from /proc/meminfo
+        """
+        info = self.meminfo()
+
+        total   = info['MemTotal']
+        free    = info['MemFree']
+        buffers = info.get('Buffers', 0)
+        cached  = info.get('Cached', 0) + info.get('SReclaimable', 0)
+
+        used = total - free - buffers - cached
+        if used < 0:
+            used = total - free
+
+        # kernels before 3.14 have no MemAvailable, estimate it like old free did:
+        available = info.get('MemAvailable', min(free + buffers + cached, total))
+
+        memory = dict()
+        memory['total']        = total
+        memory['used']         = used
+        memory['free']         = free
+        memory['shared']       = info.get('Shmem', 0)
+        memory['buff/cache']   = buffers + cached
+        memory['available']    = available
+        memory['buffers']      = buffers
+        memory['cached']       = cached
+        memory['dirty']        = info.get('Dirty', 0)
+        memory['writeback']    = info.get('Writeback', 0)
+        memory['committed_as'] = info.get('Committed_AS', 0)
+        memory['commit_limit'] = info.get('CommitLimit', 0)
+        memory['hugepages_total'] = info.get('HugePages_Total', 0)
+        memory['hugepages_free']  = info.get('HugePages_Free', 0)
+        memory['hugepagesize']    = info.get('Hugepagesize', 0)
+
+        swapinfo = dict()
+        swapinfo['total']  = info.get('SwapTotal', 0)
+        swapinfo['free']   = info.get('SwapFree', 0)
+        swapinfo['used']   = swapinfo['total'] - swapinfo['free']
+        swapinfo['cached'] = info.get('SwapCached', 0)
+
+        self.publish({'memory': memory, 'swapinfo': swapinfo})
 
     # -----------------------------------------------------------------------------
     # swapmem_print()
@@ -126,6 +1011,10 @@ class Diag:
     def swapmem_print(self):
         """pretty-print the memory and swap information
         """
+        self.need('memory')
+        if self.not_collected('memory'):
+            return
+
         print('    memory:')
         p = self.memory
         print('             used:', self.humanize(p['used']).rjust(7))
@@ -134,6 +1023,12 @@ class Diag:
         print('       buff/cache:', self.humanize(p['buff/cache']).rjust(7))
         print('           shared:', self.humanize(p['shared']).rjust(7))
         print('            total:', self.humanize(p['total']).rjust(7))
+        print('            dirty:', self.humanize(p['dirty']).rjust(7))
+        print('        writeback:', self.humanize(p['writeback']).rjust(7))
+        print('     committed_as:', self.humanize(p['committed_as']).rjust(7))
+        if p['hugepages_total'] > 0:
+            print('        hugepages:', str(p['hugepages_free']), 'free of', \
+                    str(p['hugepages_total']), '(' + self.humanize(p['hugepagesize']) + ' each)')
         print()
 
         print('    swap:')
@@ -143,36 +1038,71 @@ class Diag:
         print('            total:', self.humanize(p['total']).rjust(7))
         print()
 
+    # -----------------------------------------------------------------------------
+    # cpu_times()
+    # -----------------------------------------------------------------------------
+    def cpu_times(self):
+        """read the jiffy counters for each CPU from /proc/stat,
+           returns {'all': [user, nice, system, idle, iowait, irq,
+           softirq, steal, guest, guest_nice], '0': [...], ...}
+        """
+        times = dict()
+        for line in proc_read('/proc/stat').splitlines():
+            # the cpu lines come first, stop at the first one that isn't:
+            if not line.startswith('cpu'):
+                break
+
+            parts = line.split()
+            fields = [int(x) for x in parts[1:11]]
+            fields += [0] * (10 - len(fields)) # older kernels have fewer columns
+            times[parts[0][3:] or 'all'] = fields
+
+        return times
+
     # -----------------------------------------------------------------------------
     # cpus_load()
     # -----------------------------------------------------------------------------
     def cpus_load(self):
         """get current load information for each CPU
+           /proc/stat is read twice, cpu_interval seconds apart
+           (or once, against the previous call), same columns as mpstat
         """
-        work = subprocess.check_output(['/usr/bin/mpstat', '-P', 'ALL'], \
-                stderr=subprocess.STDOUT)
-        work = work.decode('utf-8')
-
-        cpu_array = work.splitlines()
+        before = self.cpu_times_prev
+        if before is None:
+            before = self.cpu_times()
+            time.sleep(self.cpu_interval)
 
-        # headings holds the keys to cpus dictionary:
-        headings =  cpu_array[2].split()
-        headings[0] = 'Time'
-        headings[1] = 'AM/PM'
+        after = self.cpu_times()
+        self.cpu_times_prev = after
 
-        self.cpu_count = len(cpu_array) - 4
-
-        for line in range(4, len(cpu_array)):
-            cpu_parts = cpu_array[line].split()
-            td = dict()
+        cpus = dict()
+        for cpu in after:
+            if cpu not in before:
+                continue # CPU came online between samples
 
-            i = 0
-            for hdr in headings:
-                td[hdr] = cpu_parts[i]
-                i += 1
+            d = [a - b for a, b in zip(after[cpu], before[cpu])]
+            user, nice, system, idle, iowait, irq, soft, steal, guest, gnice = d
 
-            self.cpus[cpu_parts[2]] = td
+            # guest time is already counted in user and nice:
+            total = user + nice + system + idle + iowait + irq + soft + steal
+            if total <= 0:
+                total = 1
 
+            td = dict()
+            td['CPU']     = cpu
+            td['%usr']    = round(100.0 * (user - guest) / total, 2)
+            td['%nice']   = round(100.0 * (nice - gnice) / total, 2)
+            td['%sys']    = round(100.0 * system / total, 2)
+            td['%iowait'] = round(100.0 * iowait / total, 2)
+            td['%irq']    = round(100.0 * irq / total, 2)
+            td['%soft']   = round(100.0 * soft / total, 2)
+            td['%steal']  = round(100.0 * steal / total, 2)
+            td['%guest']  = round(100.0 * guest / total, 2)
+            td['%gnice']  = round(100.0 * gnice / total, 2)
+            td['%idle']   = round(100.0 * idle / total, 2)
+            cpus[cpu] = td
+
+        self.publish({'cpus': cpus, 'cpu_count': len(cpus) - 1}) # don't count 'all'
 
     # -----------------------------------------------------------------------------
     # cpus_print()
@@ -180,54 +1110,170 @@ class Diag:
     def cpus_print(self):
         """pretty-print CPU load info we've collected
         """
-        for i in range(0, self.cpu_count):
+        self.need('cpus')
+        if self.not_collected('cpus'):
+            return
+
+        cpu_ids = sorted([int(x) for x in self.cpus if x != 'all'])
+        for i in cpu_ids:
             print('    CPU', str(i) + ':', end=' ')
             x = self.cpus[str(i)]
 
-            print(x['%idle'] + '% idle')
+            print('{:.2f}'.format(x['%idle']) + '% idle', end=' ')
+            print('(usr {:.2f} sys {:.2f} iowait {:.2f} steal {:.2f})'.format( \
+                    x['%usr'], x['%sys'], x['%iowait'], x['%steal']))
+
+    # -----------------------------------------------------------------------------
+    # net_counters(iface)
+    # -----------------------------------------------------------------------------
+    def net_counters(self, iface):
+        """read the sysfs statistics counters for one interface,
+           returns None if the interface isn't there
+        """
+        counters = dict()
+        stats = '/sys/class/net/' + iface + '/statistics/'
+        try:
+            for name in NET_COUNTERS:
+                counters[name] = int(proc_read(stats + name))
+        except (IOError, OSError, ValueError) as error:
+            return None
+
+        return counters
+
+    # -----------------------------------------------------------------------------
+    # net_address(iface)
+    # -----------------------------------------------------------------------------
+    def net_address(self, iface):
+        """get the IPv4 address of an interface, without forking ifconfig
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            packed = fcntl.ioctl(sock.fileno(), 0x8915, # SIOCGIFADDR
+                    struct.pack('256s', iface[:15].encode('utf-8')))
+            return socket.inet_ntoa(packed[20:24])
+        except (IOError, OSError) as error:
+            return ''
+        finally:
+            sock.close()
 
     # -----------------------------------------------------------------------------
     # network_load()
     # -----------------------------------------------------------------------------
     def network_load(self):
-        """get network info
+        """get network info for every interface in net_list
+           counters come from /sys/class/net/<iface>/statistics,
+           rates are per second since the previous sample
         """
-        index = 5
-        work = subprocess.check_output(['/usr/sbin/ifconfig', self.net_interface], \
-                stderr=subprocess.STDOUT)
-        work = work.decode('utf-8')
+        before = self.net_counters_prev
+        if before is None:
+            before = dict()
+            for iface in self.net_list:
+                before[iface] = (time.time(), self.net_counters(iface))
+            time.sleep(self.net_interval)
+
+        after = dict()
+        for iface in self.net_list:
+            after[iface] = (time.time(), self.net_counters(iface))
+        self.net_counters_prev = after
+
+        network = dict()
+        for iface in self.net_list:
+            sysdir = '/sys/class/net/' + iface + '/'
+            now, c = after[iface]
+            td = dict()
+            td['name'] = iface
+
+            if c is None:
+                td['operstate'] = 'missing'
+                td['header'] = iface + ': not found in /sys/class/net'
+                network[iface] = td
+                continue
+
+            td['operstate'] = proc_read(sysdir + 'operstate').strip()
+            try:
+                td['speed'] = int(proc_read(sysdir + 'speed'))
+            except (IOError, OSError, ValueError) as error:
+                td['speed'] = -1    # link down or virtual interface
+            td['mtu'] = int(proc_read(sysdir + 'mtu'))
+            td['address'] = self.net_address(iface)
+
+            td['header'] = iface + ': ' + td['operstate'] + ', mtu ' + str(td['mtu'])
+            if td['speed'] > 0:
+                td['header'] += ', ' + str(td['speed']) + 'Mb/s'
+
+            td['counters'] = c
+            td['rx_errors'] = { \
+                    'errors':   c['rx_errors'], \
+                    'dropped':  c['rx_dropped'], \
+                    'overruns': c['rx_fifo_errors'], \
+                    'frame':    c['rx_frame_errors'] }
+            td['tx_errors'] = { \
+                    'errors':     c['tx_errors'], \
+                    'dropped':    c['tx_dropped'], \
+                    'overruns':   c['tx_fifo_errors'], \
+                    'carrier':    c['tx_carrier_errors'], \
+                    'collisions': c['collisions'] }
+
+            # rates since the previous sample:
+            then, p = before.get(iface, (now, None))
+            td['rates'] = dict()
+            if p is not None and now > then:
+                for name in ['rx_bytes', 'tx_bytes', 'rx_packets', 'tx_packets']:
+                    td['rates'][name] = max(c[name] - p[name], 0) / (now - then)
+
+            network[iface] = td
+
+        self.publish({'network': network})
+
+    # -----------------------------------------------------------------------------
+    # ping_once(target)
+    # -----------------------------------------------------------------------------
+    def ping_once(self, target):
+        """send one ping to target, wait at most ping_timeout seconds
+           (ping itself only takes whole seconds, rounded up),
+           returns the round trip time in ms, or None if no answer
+        """
+        try:
+            work = subprocess.run(['/usr/bin/ping', '-c', '1', \
+                    '-W', str(max(1, int(math.ceil(self.ping_timeout)))), target], \
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, \
+                    timeout=self.ping_timeout + 1)
+        except (subprocess.TimeoutExpired, OSError) as error:
+            return None
 
-        net_lines = work.splitlines()
-        self.network['header'] = net_lines[0]
-        self.network['address'] = net_lines[1].split()[1]
+        if work.returncode != 0:
+            return None
 
-        if 'inet6' not in str(net_lines[2]):
-            index =4
+        rtt = PING_RTT.search(work.stdout.decode('utf-8'))
+        if rtt is None:
+            return 0.0
+        return float(rtt.group(1))
 
-        parts = net_lines[index].split()
-        self.network['rx_errors'] = { \
-                'errors':   parts[2], \
-                'dropped':  parts[4], \
-                'overruns': parts[6], \
-                'frame':    parts[8] }
+    # -----------------------------------------------------------------------------
+    # ping_host(name, ip)
+    # -----------------------------------------------------------------------------
+    def ping_host(self, name, ip):
+        """ping a host by name, then by ip if that fails
+        """
+        td = {'ip': ip, 'rtt': None, 'by': None}
+        for by, target in [('name', name), ('ip', ip)]:
+            td['rtt'] = self.ping_once(target)
+            if td['rtt'] is not None:
+                td['by'] = by
+                break
 
-        parts = net_lines[index + 2].split()
-        self.network['tx_errors'] = { \
-                'errors':     parts[2], \
-                'dropped':    parts[4], \
-                'overruns':   parts[6], \
-                'carrier':    parts[8], \
-                'collisions': parts[10] }
+        return td
 
     # -----------------------------------------------------------------------------
     # netping_load()
     # -----------------------------------------------------------------------------
     def netping_load(self):
         """do the sysping thing
+           hosts are pinged in parallel, at most ping_workers at a time,
+           anything still going after ping_deadline seconds is given up on;
+           the workers are daemon threads, so stragglers don't hold up exit
         """
         names = []
-        pingoutput = ''
-        pingerrors = []
 
         with open('/etc/hosts', 'r') as hostsfile:
             hostslines = hostsfile.readlines()
@@ -244,61 +1290,129 @@ class Diag:
             entrylist = line.split()
             names.append((str(entrylist[-1]), str(entrylist[0])))
 
+        # not a ThreadPoolExecutor, the interpreter waits for those at exit:
+        todo = list(reversed(names))
+        todo_lock = threading.Lock()
+        results = dict()
+        deadline = time.time() + self.ping_deadline
+
+        def pinger():
+            while time.time() < deadline:
+                with todo_lock:
+                    if len(todo) == 0:
+                        return
+                    pinghost = todo.pop()
+                results[pinghost] = self.ping_host(pinghost[0], pinghost[1])
+
+        workers = []
+        for i in range(min(self.ping_workers, len(names))):
+            worker = threading.Thread(target=pinger, name='sysdiag-ping', daemon=True)
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join(max(deadline - time.time(), 0))
+
+        # report in /etc/hosts order:
+        netping = dict()
+        netping_lines = []
         for pinghost in names:
-            try:
-                pingoutput = subprocess.check_output(['/usr/bin/ping', \
-                        '-c','1', pinghost[0]], stderr=subprocess.STDOUT)
-                pingoutput = pingoutput.decode('utf-8')
-                pingoutput = pingoutput.rstrip() # single-line response needs rstrip()
+            td = results.get(pinghost)
+            if td is None:
+                netping[pinghost[0]] = {'ip': pinghost[1], 'rtt': None, 'by': None}
+                netping_lines.append("can't ping " + pinghost[0] + \
+                        ': no answer within ' + str(self.ping_deadline) + 's deadline')
+                continue
 
-            except subprocess.CalledProcessError as error:
-                self.netping_lines.append("can't ping " + pinghost[0] + ' by name, trying ip ' + pinghost[1])
-                try:
-                    pingoutput = subprocess.check_output(['/usr/bin/ping', \
-                            '-c','1', pinghost[1]], stderr=subprocess.STDOUT)
-                    pingoutput = pingoutput.decode('utf-8')
-                    pingoutput = pingoutput.rstrip() # single-line response needs rstrip()
-                except subprocess.CalledProcessError as error:
-                    self.netping_lines.append("can't ping " + pinghost[0] + ' by ip: ' + pinghost[1])
+            netping[pinghost[0]] = td
+            if td['by'] != 'name':
+                netping_lines.append("can't ping " + pinghost[0] + ' by name, trying ip ' + pinghost[1])
+            if td['by'] is None:
+                netping_lines.append("can't ping " + pinghost[0] + ' by ip: ' + pinghost[1])
+
+        self.publish({'netping': netping, 'netping_lines': netping_lines})
 
     # -----------------------------------------------------------------------------
-    # service_check()
+    # services_query(units)
     # -----------------------------------------------------------------------------
-    def service_check(self, svc):
-        """check given service,
-           returns tokens 2 & 3 from line 3 of systemctl status:
-           'active/dead/whatever', 'running/exited/stopped/dead/missing'
+    def services_query(self, units):
+        """ask systemd about all the given units in one systemctl show call,
+           returns {unit: {'ActiveState': ..., 'SubState': ..., 'MainPID': ...,
+           'MemoryCurrent': ..., 'NRestarts': ...}}
         """
+        info = dict()
+        if len(units) == 0:
+            return info
+
         try:
-            work = subprocess.check_output(['/usr/bin/systemctl', 'status', svc], \
+            work = subprocess.check_output(['/usr/bin/systemctl', 'show', \
+                    '-p', ','.join(SYSTEMD_PROPS), '--'] + units, \
                     stderr=subprocess.STDOUT)
-            work = work.decode('utf-8')
-#            work = work.rstrip()
         except subprocess.CalledProcessError as error:
             work = error.output
+        except OSError as error:
+            work = str(error).encode('utf-8')
+        work = work.decode('utf-8')
 
-        svclines = work.splitlines()
+        # one block of key=value lines per unit, in the order we asked:
+        blocks = []
+        for block in work.strip().split('\n\n'):
+            props = dict()
+            for line in block.splitlines():
+                if '=' in line:
+                    k, v = line.split('=', 1)
+                    props[k] = v
+            if 'ActiveState' in props:
+                blocks.append(props)
+
+        if len(blocks) != len(units):
+            for unit in units:
+                info[unit] = {'LoadState': 'unknown', \
+                        'ActiveState': 'unknown', 'SubState': 'unknown', \
+                        'MainPID': 0, 'MemoryCurrent': None, 'NRestarts': None, \
+                        'error': work.strip()}
+            return info
+
+        for unit, props in zip(units, blocks):
+            td = dict()
+            td['LoadState']   = props.get('LoadState', '')
+            td['ActiveState'] = props['ActiveState']
+            td['SubState']    = props.get('SubState', '')
+            td['MainPID']     = int(props.get('MainPID', '0') or 0)
 
-        # take work, split it into lines, take the 3rd line, split it into parts:
-        try:
-            parts = svclines[2].split()
-        except IndexError as error:
-            print('service_check(): len(svclines) =', len(svclines), 'Returning:')
-            print(work)
-            print()
-            return work
+            # these are '[not set]' or missing on older systemd:
+            for k in ['MemoryCurrent', 'NRestarts']:
+                v = props.get(k, '')
+                td[k] = int(v) if v.isdigit() and int(v) < 2 ** 63 else None
+
+            info[unit] = td
 
-        # return active/inactive, (running/stopped/exited):
-        return parts[1], parts[2]
+        return info
+
+    # -----------------------------------------------------------------------------
+    # service_check()
+    # -----------------------------------------------------------------------------
+    def service_check(self, svc):
+        """check given service,
+           returns 'active/inactive/failed/whatever', '(running/exited/dead/...)'
+           the same two words systemctl status shows
+        """
+        x = self.services_query([svc])[svc]
+        return x['ActiveState'], '(' + x['SubState'] + ')'
 
     # -----------------------------------------------------------------------------
     # services_load()
     # -----------------------------------------------------------------------------
     def services_load(self):
         """gather services info into services dictionary
+           all the services are asked about in a single systemctl call
         """
+        services_info = self.services_query(self.services_list)
+        services = dict()
         for svc in self.services_list:
-            self.services[svc] = self.service_check(svc)
+            x = services_info[svc]
+            services[svc] = (x['ActiveState'], '(' + x['SubState'] + ')')
+
+        self.publish({'services': services, 'services_info': services_info})
 
     # -----------------------------------------------------------------------------
     # network_print()
@@ -306,33 +1420,502 @@ class Diag:
     def network_print(self):
         """pretty-print the network information
         """
-        print('    interface:', self.network['header'])
-        print('      address:', self.network['address'])
+        self.need('network')
+        if self.not_collected('network'):
+            return
 
-        print('    RX errors:', end=' ')
-        x = self.network['rx_errors']
-        for k,v in list(x.items()):
-            print(k + ':', v, end=' ')
-        print()
+        for iface in self.net_list:
+            if iface != self.net_list[0]:
+                print()
 
-        print('    TX errors:', end=' ')
-        x = self.network['tx_errors']
-        for k,v in list(x.items()):
-            print(k + ':', v, end=' ')
-        print()
+            n = self.network[iface]
+            print('    interface:', n['header'])
+            if n['operstate'] == 'missing':
+                continue
+
+            print('      address:', n['address'])
+
+            r = n['rates']
+            if len(r) > 0:
+                print('      RX rate:', self.humanize(int(r['rx_bytes'])) + '/s', \
+                        '{:.1f}'.format(r['rx_packets']), 'pkts/s')
+                print('      TX rate:', self.humanize(int(r['tx_bytes'])) + '/s', \
+                        '{:.1f}'.format(r['tx_packets']), 'pkts/s')
+
+            print('    RX errors:', end=' ')
+            x = n['rx_errors']
+            for k,v in list(x.items()):
+                print(k + ':', v, end=' ')
+            print()
+
+            print('    TX errors:', end=' ')
+            x = n['tx_errors']
+            for k,v in list(x.items()):
+                print(k + ':', v, end=' ')
+            print()
+
+    # -----------------------------------------------------------------------------
+    # uptime_load()
+    # -----------------------------------------------------------------------------
+    def uptime_load(self):
+        """get the uptime and load averages the way w shows them,
+           and the current date and time
+        """
+        up = int(float(proc_read('/proc/uptime').split()[0]))
+        days, up = divmod(up, 86400)
+        hours, up = divmod(up, 3600)
+        minutes = up // 60
+
+        work = 'up '
+        if days > 0:
+            work += str(days) + ' day' + ('s' if days > 1 else '') + ', '
+        if hours > 0:
+            work += '{}:{:02d}, '.format(hours, minutes)
+        else:
+            work += str(minutes) + ' min, '
+
+        load = proc_read('/proc/loadavg').split()
+        self.uptime = work + 'load average: ' + ', '.join(load[:3])
+
+        # current date and time:
+        self.datestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    # -----------------------------------------------------------------------------
+    # proc_scan(before, elapsed)
+    # -----------------------------------------------------------------------------
+    def proc_scan(self, before=None, elapsed=1.0):
+        """one pass over /proc/[pid]/stat and io, returns ({pid: cpu ticks},
+           {pid: io bytes}, (processes, threads), tops). With a previous scan
+           to diff against, tops is {'cpu', 'rss', 'io'} TopN heaps of pids,
+           nothing else about a process is kept
+        """
+        ticks = dict()
+        iobytes = dict()
+        count = 0
+        threads = 0
+        tops = None
+        if before is not None:
+            tops = {'cpu': TopN(self.proc_top), 'rss': TopN(self.proc_top), 'io': TopN(self.proc_top)}
+            pagesize = os.sysconf('SC_PAGE_SIZE')
+
+        with os.scandir('/proc') as it:
+            for entry in it:
+                if not entry.name.isdigit():
+                    continue
+
+                # plain os.open()/os.read(), a buffered file object per read costs more than the read:
+                pid = int(entry.name)
+                try:
+                    fd = os.open('/proc/' + entry.name + '/stat', os.O_RDONLY)
+                    try:
+                        stat = os.read(fd, 4096)
+                    finally:
+                        os.close(fd)
+                except (IOError, OSError) as error:
+                    continue # it exited
+
+                # the command name can hold spaces and parens, fields start after the last ')':
+                fields = stat[stat.rfind(b')') + 2:].split()
+                ticks[pid] = int(fields[11]) + int(fields[12])   # utime + stime
+                count += 1
+                threads += int(fields[17])
+
+                # other users' io needs root, those just count as no I/O:
+                try:
+                    fd = os.open('/proc/' + entry.name + '/io', os.O_RDONLY)
+                    try:
+                        io = os.read(fd, 4096).split()
+                    finally:
+                        os.close(fd)
+                    iobytes[pid] = int(io[9]) + int(io[11])   # read_bytes + write_bytes
+                except (IOError, OSError) as error:
+                    pass
+
+                if tops is None:
+                    continue
+
+                # idle processes and kernel threads (no rss) aren't worth a slot:
+                rss = int(fields[21]) * pagesize
+                if rss > 0:
+                    tops['rss'].push(rss, pid)
+                if pid in before[0] and ticks[pid] > before[0][pid]:
+                    tops['cpu'].push(100.0 * (ticks[pid] - before[0][pid]) / CLK_TCK / elapsed, pid)
+                if pid in iobytes and pid in before[1] and iobytes[pid] > before[1][pid]:
+                    tops['io'].push((iobytes[pid] - before[1][pid]) / elapsed, pid)
+
+        return ticks, iobytes, (count, threads), tops
+
+    # -----------------------------------------------------------------------------
+    # proc_info(pid)
+    # -----------------------------------------------------------------------------
+    def proc_info(self, pid):
+        """name, user, state and command line of one process from
+           /proc/[pid]/status and cmdline, None if it's gone
+        """
+        info = {'pid': pid, 'name': '', 'user': '', 'state': '', 'cmd': ''}
+        try:
+            with open('/proc/' + str(pid) + '/status', 'r') as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key == 'Name':
+                        info['name'] = value.strip()
+                    elif key == 'State':
+                        info['state'] = value.split()[0]
+                    elif key == 'Uid':
+                        uid = int(value.split()[0])
+                        try:
+                            info['user'] = pwd.getpwuid(uid).pw_name
+                        except KeyError:
+                            info['user'] = str(uid)
+                        break
+
+            with open('/proc/' + str(pid) + '/cmdline', 'rb') as f:
+                cmd = f.read().decode('utf-8', 'replace')
+        except (IOError, OSError) as error:
+            return None
+
+        # kernel threads have no command line:
+        info['cmd'] = cmd.replace('\0', ' ').strip()[:256] or '[' + info['name'] + ']'
+        return info
+
+    # -----------------------------------------------------------------------------
+    # procs_load()
+    # -----------------------------------------------------------------------------
+    def procs_load(self):
+        """find the top proc_top processes by CPU, resident memory and I/O
+           /proc is scanned twice, proc_interval seconds apart
+           (or once, against the previous call)
+        """
+        before = self.proc_prev
+        if before is None:
+            before = self.proc_scan()[0:2] + (time.time(),)
+            time.sleep(self.proc_interval)
+
+        ticks, iobytes, counts, tops = self.proc_scan(before, max(time.time() - before[2], 0.001))
+        self.proc_prev = (ticks, iobytes, time.time())
+
+        procs = dict()
+        procs['count'], procs['threads'] = counts
+
+        # status and cmdline only for the winners, a pid can win more than once:
+        infos = dict()
+        for key in ['cpu', 'rss', 'io']:
+            procs[key] = []
+            for value, pid in tops[key].items():
+                if pid not in infos:
+                    infos[pid] = self.proc_info(pid)
+                if infos[pid] is None:
+                    continue # it exited
+                td = dict(infos[pid])
+                td[key] = value
+                procs[key].append(td)
+
+        self.publish({'procs': procs})
+
+    # -----------------------------------------------------------------------------
+    # procs_print()
+    # -----------------------------------------------------------------------------
+    def procs_print(self):
+        """pretty-print the top processes we've collected
+        """
+        self.need('procs')
+        if self.not_collected('procs'):
+            return
+
+        print('    processes:', self.procs['count'], ' threads:', self.procs['threads'])
+        for key, title, fmt in [('cpu', 'by CPU:', lambda x: '{:.1f}%'.format(x)), \
+                ('rss', 'by resident memory:', self.humanize), \
+                ('io', 'by disk I/O:', lambda x: self.humanize(int(x)) + '/s')]:
+            print('    ' + title)
+            for p in self.procs[key]:
+                print('      ' + str(p['pid']).rjust(7) + ' ' + p['user'][:10].ljust(10) + \
+                        fmt(p[key]).rjust(9) + '  ' + p['cmd'][:60])
+
+    # -----------------------------------------------------------------------------
+    # collect(subsystems)
+    # -----------------------------------------------------------------------------
+    def collect(self, subsystems=None):
+        """load the dictionaries for the given subsystems (default: all of them)
+           each loader runs in its own thread, all at the same time;
+           one that's still going after its timeout is marked timed out
+           and left behind, so it can't hold up the others; while it's
+           still stuck that subsystem isn't started again, just timed out,
+           and whatever it comes back with is thrown away (see publish())
+        """
+        if subsystems is None:
+            subsystems = SUBSYSTEMS
+
+        workers = []
+        for name in subsystems:
+            stuck = self.workers.get(name)
+            if stuck is not None and stuck.is_alive():
+                self.timed_out[name] = self.timeouts[name]
+                self.collected.add(name)
+                continue
+
+            self.timed_out.pop(name, None)
+            self.failed.pop(name, None)
+            self.generation[name] = self.generation.get(name, 0) + 1
+            worker = threading.Thread(target=self.collect_one, \
+                    args=(name, self.generation[name]), name='sysdiag-' + name, daemon=True)
+            worker.start()
+            self.workers[name] = worker
+            workers.append((name, worker, time.time() + self.timeouts[name]))
+
+        for name, worker, deadline in workers:
+            worker.join(max(deadline - time.time(), 0))
+            with self.publish_lock:
+                # still going and nothing published: this run doesn't count any more
+                if worker.is_alive() and self.published.get(name) != self.generation[name]:
+                    self.generation[name] += 1
+                    self.timed_out[name] = self.timeouts[name]
+            self.collected.add(name)
+
+    # -----------------------------------------------------------------------------
+    # collect_one(subsystem, generation)
+    # -----------------------------------------------------------------------------
+    def collect_one(self, name, generation):
+        """run one loader, remember why if it blows up
+        """
+        self.run.name = name
+        self.run.generation = generation
+        try:
+            getattr(self, LOADERS[name])()
+        except Exception as error:
+            with self.publish_lock:
+                if self.generation.get(name) == generation:
+                    self.failed[name] = str(error)
+
+    # -----------------------------------------------------------------------------
+    # publish(values)
+    # -----------------------------------------------------------------------------
+    def publish(self, values):
+        """how a loader hands over its results, {attribute: new value};
+           each value is a fresh object swapped in whole, so readers never
+           see one half filled, and a run collect() has already given up
+           on as timed out changes nothing; returns False if it was dropped
+        """
+        name = getattr(self.run, 'name', None)
+        with self.publish_lock:
+            if name is not None and self.generation.get(name) != self.run.generation:
+                return False
+            for attr in values:
+                setattr(self, attr, values[attr])
+            if name is not None:
+                self.published[name] = self.run.generation
+        return True
+
+    # -----------------------------------------------------------------------------
+    # not_collected(subsystem)
+    # -----------------------------------------------------------------------------
+    def not_collected(self, name):
+        """if a subsystem timed out or failed, say so and return True
+        """
+        if name in self.timed_out:
+            print('    timed out after {:g}s'.format(self.timed_out[name]))
+            return True
+
+        if name in self.failed:
+            print('    collection failed:', self.failed[name])
+            return True
+
+        return False
+
+    # -----------------------------------------------------------------------------
+    # need(subsystem)
+    # -----------------------------------------------------------------------------
+    def need(self, name):
+        """collect a subsystem if we haven't yet
+        """
+        if name not in self.collected:
+            self.collect([name])
+
+    # -----------------------------------------------------------------------------
+    # samples()
+    # -----------------------------------------------------------------------------
+    def samples(self):
+        """flatten what we've collected into a list of (metric, number)
+        """
+        out = []
+        for disk in self.disk_list:
+            p = self.disks.get(disk, {})
+            if 'usep' in p:
+                out.append(('disk.' + disk + '.used', p['used']))
+                out.append(('disk.' + disk + '.usep', p['usep']))
+            if p.get('io') is not None:
+                out.append(('disk.' + disk + '.iops', p['io']['iops']))
+                out.append(('disk.' + disk + '.mbps', p['io']['MB/s']))
+                out.append(('disk.' + disk + '.await', p['io']['await']))
+                out.append(('disk.' + disk + '.util', p['io']['%util']))
+
+        for cpu in self.cpus:
+            out.append(('cpu.' + cpu + '.busy', 100.0 - self.cpus[cpu]['%idle']))
+        if 'all' in self.cpus:
+            out.append(('cpu.all.iowait', self.cpus['all']['%iowait']))
+            out.append(('cpu.all.steal', self.cpus['all']['%steal']))
+
+        for k in ['used', 'available', 'buff/cache', 'dirty']:
+            if k in self.memory:
+                out.append(('mem.' + k, self.memory[k]))
+        if 'used' in self.swapinfo:
+            out.append(('swap.used', self.swapinfo['used']))
+
+        for iface in self.net_list:
+            n = self.network.get(iface, {})
+            r = n.get('rates', {})
+            if 'rx_bytes' in r:
+                out.append(('net.' + iface + '.rx_bps', r['rx_bytes']))
+                out.append(('net.' + iface + '.tx_bps', r['tx_bytes']))
+            if 'counters' in n:
+                out.append(('net.' + iface + '.errors', \
+                        n['counters']['rx_errors'] + n['counters']['tx_errors']))
+
+        for svc in self.services:
+            x = self.services[svc]
+            out.append(('svc.' + svc + '.up', \
+                    1 if x[0] == 'active' and x[1] == '(running)' else 0))
+
+        for host in self.netping:
+            if self.netping[host]['rtt'] is not None:
+                out.append(('ping.' + host + '.rtt', self.netping[host]['rtt']))
+
+        if 'count' in self.procs:
+            out.append(('proc.count', self.procs['count']))
+            out.append(('proc.threads', self.procs['threads']))
+
+        return out
+
+    # -----------------------------------------------------------------------------
+    # snapshot(subsystems)
+    # -----------------------------------------------------------------------------
+    def snapshot(self, subsystems=None):
+        """the raw dictionaries for the given subsystems (default: what we've
+           collected) in one dictionary, ready for json
+        """
+        if subsystems is None:
+            subsystems = [x for x in SUBSYSTEMS if x in self.collected]
+
+        snap = dict()
+        snap['ts'] = time.time()
+        snap['system_name'] = self.sysname
+        snap['os_version'] = self.os_version
+        snap['uptime'] = self.uptime
+        snap['datestamp'] = self.datestamp
+
+        for name in subsystems:
+            if name == 'disks':
+                snap['disks'] = self.disks
+            if name == 'cpus':
+                snap['cpus'] = self.cpus
+            if name == 'memory':
+                snap['memory'] = self.memory
+                snap['swapinfo'] = self.swapinfo
+            if name == 'network':
+                snap['network'] = self.network
+            if name == 'netping':
+                snap['netping'] = self.netping
+                snap['netping_lines'] = self.netping_lines
+            if name == 'services':
+                snap['services'] = self.services
+                snap['services_info'] = self.services_info
+            if name == 'procs':
+                snap['procs'] = self.procs
+
+        snap['timed_out'] = dict([(x, self.timed_out[x]) for x in subsystems if x in self.timed_out])
+        snap['failed'] = dict([(x, self.failed[x]) for x in subsystems if x in self.failed])
+        return snap
+
+    # -----------------------------------------------------------------------------
+    # refresh(subsystems)
+    # -----------------------------------------------------------------------------
+    def refresh(self, subsystems=None):
+        """take a new sample of what we've collected so far (or of subsystems),
+           updating this instance in place; the .ini file is not read again
+        """
+        if subsystems is None:
+            subsystems = [x for x in SUBSYSTEMS if x in self.collected]
+
+        self.uptime_load()
+        self.collect(subsystems)
+        if self.history is not None:
+            self.history.add(time.time(), self.samples())
 
     # -----------------------------------------------------------------------------
     # __init__()
     # -----------------------------------------------------------------------------
-    def __init__(self):
+    def __init__(self, subsystems=None):
         """ Bring in the local .ini file
             The .ini file consists of comments, blank lines, and key-value pairs.
             The following keys are recognized in the .ini file:
                 system_name - the FQDN of this system
-                network     - the network interface name, shown in ifconfig
+                network     - multiple entries for network interfaces we track
+                cpu_interval - seconds between /proc/stat samples (default 0.25)
+                net_interval - seconds between network counter samples (default 0.25)
+                ping_workers - how many hosts to ping at once (default 32)
+                ping_timeout - seconds to wait for each ping (default 2)
+                ping_deadline - seconds to wait for the whole sysping (default 30)
+                disk_timeout - seconds to wait for statvfs on each disk (default 2)
+                io_interval - seconds between /proc/diskstats samples (default 0.25)
+                proc_interval - seconds between /proc/[pid] scans (default 0.5)
+                proc_top    - how many processes to list per resource (default 10)
+                stale_ttl   - seconds to skip a disk after it hangs (default 300)
+                stale_cache - file that remembers hung disks between runs
+                history_keep - how long --db keeps samples, like 7d (default)
+                timeout_<subsystem> - seconds to wait for that collector (see TIMEOUTS)
                 disk        - mulitple entries for disks we track
                 service     - multiple entries for systemctl services
+
+            subsystems is the list of SUBSYSTEMS to collect up front,
+            default all of them. Anything else is collected on first print.
         """
+        # instance variables, every Diag gets its own:
+        self.collected = set()
+        self.cpu_count = 0
+        self.cpu_interval = 0.25
+        self.cpu_times_prev = None
+        self.cpus = dict()
+        self.datestamp = ''
+        self.disk_list = []
+        self.disk_count = 0
+        self.disk_timeout = 2.0
+        self.disk_workers = dict()
+        self.disks = dict()
+        self.diskstats_prev = None
+        self.failed = dict()
+        self.history = None
+        self.io_interval = 0.25
+        self.history_keep = 7 * 86400
+        self.memory = dict()
+        self.network = dict()
+        self.net_counters_prev = None
+        self.net_interface = ''
+        self.net_interval = 0.25
+        self.net_list = []
+        self.netping = dict()
+        self.netping_lines = []
+        self.ping_deadline = 30.0
+        self.ping_timeout = 2
+        self.ping_workers = 32
+        self.os_version = ''
+        self.proc_interval = 0.5
+        self.proc_prev = None
+        self.proc_top = 10
+        self.procs = dict()
+        self.services_list = []
+        self.services = dict()
+        self.services_info = dict()
+        self.stale_cache = '/var/tmp/sysdiag-stale.cache'
+        self.stale_ttl = 300.0
+        self.swapinfo = dict()
+        self.sysname = ''
+        self.timed_out = dict()
+        self.timeouts = dict(TIMEOUTS)
+        self.uptime = ''
+        self.workers = dict()
+        self.generation = dict()
+        self.published = dict()
+        self.publish_lock = threading.Lock()
+        self.run = threading.local()    # which collect() run a loader thread belongs to
 
         my_path = ''
         my_path = os.path.dirname(__file__) # find out just where we are
@@ -361,7 +1944,48 @@ class Diag:
                 self.sysname = entrylist[1]
 
             if entrylist[0] == 'network':
-                self.net_interface = entrylist[1]
+                if self.net_interface == '':
+                    self.net_interface = entrylist[1]
+                self.net_list.append(entrylist[1])
+
+            if entrylist[0] == 'net_interval':
+                self.net_interval = float(entrylist[1])
+
+            if entrylist[0] == 'ping_workers':
+                self.ping_workers = int(entrylist[1])
+
+            if entrylist[0] == 'ping_timeout':
+                self.ping_timeout = float(entrylist[1])
+
+            if entrylist[0] == 'ping_deadline':
+                self.ping_deadline = float(entrylist[1])
+
+            if entrylist[0] == 'proc_interval':
+                self.proc_interval = float(entrylist[1])
+
+            if entrylist[0] == 'proc_top':
+                self.proc_top = int(entrylist[1])
+
+            if entrylist[0] == 'io_interval':
+                self.io_interval = float(entrylist[1])
+
+            if entrylist[0] == 'disk_timeout':
+                self.disk_timeout = float(entrylist[1])
+
+            if entrylist[0] == 'stale_ttl':
+                self.stale_ttl = float(entrylist[1])
+
+            if entrylist[0] == 'stale_cache':
+                self.stale_cache = entrylist[1]
+
+            if entrylist[0] == 'history_keep':
+                self.history_keep = parse_duration(entrylist[1])
+
+            if entrylist[0].startswith('timeout_') and entrylist[0][8:] in TIMEOUTS:
+                self.timeouts[entrylist[0][8:]] = float(entrylist[1])
+
+            if entrylist[0] == 'cpu_interval':
+                self.cpu_interval = float(entrylist[1])
 
             if entrylist[0] == 'service':
                 self.services_list.append(entrylist[1])
@@ -370,15 +1994,8 @@ class Diag:
                 self.disk_count += 1
                 self.disk_list.append(entrylist[1])
 
-        # snag the uptime:
-        work = subprocess.check_output(['/usr/bin/w'], stderr=subprocess.STDOUT)
-        work = work.decode('utf-8')
-        work = work.rstrip() # single-line response?...
-        # I got fancy here:
-        self.uptime = ' '.join(str(work.split('\n')[0]).split()[2:])
-
-        # current date and time:
-        self.datestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        # snag the uptime, date and time:
+        self.uptime_load()
 
         # get the os_version:
         flist = ['/etc/system-release', '/etc/redhat-release', '/etc/os-release']
@@ -396,15 +2013,903 @@ class Diag:
             print()
 
         # load up the dictionaries:
-        self.disks_load()
-        self.cpus_load()
-        self.swapmem_load()
-        self.network_load()
-        self.netping_load()
-        self.services_load()
+        self.collect(subsystems)
 
 # end of Class Diag
 
+# -----------------------------------------------------------------------------
+# class SnapshotCache
+# -----------------------------------------------------------------------------
+class SnapshotCache:
+    """The latest snapshot of a Diag, shared by everybody who wants one.
+       However many ask, the Diag is refreshed at most once every
+       min_interval seconds, and only one refresh runs at a time.
+    """
+    # -----------------------------------------------------------------------------
+    # __init__(diag, sections, min_interval)
+    # -----------------------------------------------------------------------------
+    def __init__(self, diag, lclhost, sections, min_interval=15.0):
+        """diag should already have collected sections
+        """
+        self.diag = diag
+        self.lclhost = lclhost
+        self.sections = sections
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.store()
+
+    # -----------------------------------------------------------------------------
+    # store()
+    # -----------------------------------------------------------------------------
+    def store(self):
+        """take a private copy of the Diag's current state
+        """
+        snap = self.diag.snapshot(self.sections)
+        snap['host'] = self.lclhost
+        self.text = json.dumps(snap, separators=(',', ':'))
+        self.snap = json.loads(self.text)
+        self.taken = time.time()
+
+    # -----------------------------------------------------------------------------
+    # refresh()
+    # -----------------------------------------------------------------------------
+    def refresh(self):
+        """refresh the Diag now, returns the new snapshot
+        """
+        with self.lock:
+            self.diag.refresh(self.sections)
+            self.store()
+            return self.snap
+
+    # -----------------------------------------------------------------------------
+    # get(max_age, subsystems)
+    # -----------------------------------------------------------------------------
+    def get(self, max_age=None, subsystems=None):
+        """the latest snapshot, refreshed first if it's older than max_age
+           seconds (never more often than min_interval) or if it's missing
+           any of subsystems, which are then kept from now on
+        """
+        if max_age is None or max_age < self.min_interval:
+            max_age = self.min_interval
+
+        with self.lock:
+            missing = [x for x in (subsystems or []) if x not in self.sections]
+            if len(missing) > 0:
+                self.sections = [x for x in SUBSYSTEMS if x in self.sections or x in missing]
+
+            if len(missing) > 0 or time.time() - self.taken > max_age:
+                self.diag.refresh(self.sections)
+                self.store()
+            return self.snap
+
+# -----------------------------------------------------------------------------
+# class ShmPublisher
+# -----------------------------------------------------------------------------
+class ShmPublisher:
+    """Publishes the latest snapshot in a fixed-layout memory-mapped file.
+       The sequence number is odd while a write is in progress and even
+       when it's done (a seqlock), so readers can tell a torn read.
+    """
+    # -----------------------------------------------------------------------------
+    # __init__(path, size)
+    # -----------------------------------------------------------------------------
+    def __init__(self, path=DEFAULT_SHM, size=SHM_SIZE):
+        """create (or reuse) the file and map it
+        """
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.buf = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, layout, self.seq, ts, length = SHM_HEADER.unpack_from(self.buf, 0)
+        if magic != SHM_MAGIC or self.seq % 2 == 1:
+            self.seq = 0    # new file, or the last writer died mid-write
+
+    # -----------------------------------------------------------------------------
+    # publish(text)
+    # -----------------------------------------------------------------------------
+    def publish(self, text, ts=None):
+        """write a new snapshot (json text)
+        """
+        if ts is None:
+            ts = time.time()
+
+        payload = text.encode('utf-8')
+        if len(payload) > len(self.buf) - SHM_HEADER.size:
+            payload = json.dumps({'error': 'snapshot bigger than ' + \
+                    str(len(self.buf) - SHM_HEADER.size) + ' bytes'}).encode('utf-8')
+
+        # odd sequence number: write in progress
+        self.seq += 1
+        SHM_HEADER.pack_into(self.buf, 0, SHM_MAGIC, 1, self.seq, ts, len(payload))
+        self.buf[SHM_HEADER.size:SHM_HEADER.size + len(payload)] = payload
+
+        # even again: done
+        self.seq += 1
+        SHM_HEADER.pack_into(self.buf, 0, SHM_MAGIC, 1, self.seq, ts, len(payload))
+
+    # -----------------------------------------------------------------------------
+    # close()
+    # -----------------------------------------------------------------------------
+    def close(self):
+        self.buf.close()
+
+# -----------------------------------------------------------------------------
+# shm_read(path)
+# -----------------------------------------------------------------------------
+def shm_read(path=DEFAULT_SHM, tries=1000):
+    """read the latest snapshot a ShmPublisher wrote,
+       returns (ts, snapshot dictionary), or (0, None) if nothing's there yet
+    """
+    try:
+        inp = open(path, 'rb')
+    except FileNotFoundError:
+        return 0, None
+
+    with inp:
+        # a publisher that has only just created it (mmap won't take an empty file):
+        if os.fstat(inp.fileno()).st_size < SHM_HEADER.size:
+            return 0, None
+
+        with mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for i in range(tries):
+                magic, layout, seq, ts, length = SHM_HEADER.unpack_from(buf, 0)
+                if magic != SHM_MAGIC:
+                    return 0, None
+                if seq % 2 == 1:
+                    time.sleep(0)   # writer is busy, let it finish
+                    continue
+                if SHM_HEADER.size + length > len(buf):
+                    return 0, None  # truncated
+
+                payload = buf[SHM_HEADER.size:SHM_HEADER.size + length]
+                if SHM_HEADER.unpack_from(buf, 0)[2] == seq:
+                    return ts, json.loads(payload.decode('utf-8'))
+
+    raise IOError('no consistent snapshot in ' + path + ' after ' + str(tries) + ' tries')
+
+# -----------------------------------------------------------------------------
+# socket_answer(cache, request)
+# -----------------------------------------------------------------------------
+async def socket_answer(cache, request):
+    """answer one query line, 'disks,services [max age]', with json text
+    """
+    parts = request.split()
+    subsystems = SUBSYSTEMS
+    if len(parts) > 0 and parts[0] != 'all':
+        subsystems = parts[0].split(',')
+
+    bad = [x for x in subsystems if x not in SUBSYSTEMS]
+    if len(bad) > 0:
+        return json.dumps({'error': 'unknown subsystem: ' + ','.join(bad)})
+
+    try:
+        max_age = float(parts[1]) if len(parts) > 1 else None
+    except ValueError as error:
+        return json.dumps({'error': 'bad max age: ' + parts[1]})
+
+    # collecting blocks, so it goes to a thread; the cache's lock makes
+    # everybody else who's asking wait for that one refresh:
+    loop = asyncio.get_running_loop()
+    snap = await loop.run_in_executor(None, cache.get, max_age, subsystems)
+
+    answer = dict()
+    for k in ['ts', 'host', 'system_name', 'os_version', 'uptime', 'datestamp']:
+        answer[k] = snap[k]
+    for name in subsystems:
+        for k in SNAPSHOT_KEYS[name]:
+            answer[k] = snap.get(k)
+    answer['timed_out'] = dict([(x, snap['timed_out'][x]) for x in subsystems if x in snap['timed_out']])
+    answer['failed'] = dict([(x, snap['failed'][x]) for x in subsystems if x in snap['failed']])
+    return json.dumps(answer, separators=(',', ':'))
+
+# -----------------------------------------------------------------------------
+# socket_client(cache, reader, writer)
+# -----------------------------------------------------------------------------
+async def socket_client(cache, reader, writer):
+    """talk to one client: a json line back for every query line it sends
+    """
+    try:
+        while True:
+            request = await reader.readline()
+            if len(request) == 0:
+                break
+            answer = await socket_answer(cache, request.decode('utf-8', 'replace'))
+            writer.write(answer.encode('utf-8') + b'\n')
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError) as error:
+        pass
+    finally:
+        writer.close()
+
+# -----------------------------------------------------------------------------
+# socket_serve(cache, path)
+# -----------------------------------------------------------------------------
+def socket_serve(cache, path=DEFAULT_SOCKET):
+    """start the unix socket query server on path in a background thread,
+       raises OSError if path is something else or another server has it
+    """
+    # only a socket nobody answers on is left over from the last run:
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        mode = None
+
+    if mode is not None:
+        if not stat.S_ISSOCK(mode):
+            raise OSError(path + ' exists and is not a socket')
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+        else:
+            raise OSError('another server is listening on ' + path)
+        finally:
+            probe.close()
+
+    async def run():
+        server = await asyncio.start_unix_server( \
+                lambda r, w: socket_client(cache, r, w), path=path)
+        async with server:
+            await server.serve_forever()
+
+    worker = threading.Thread(target=asyncio.run, args=(run(),), \
+            name='sysdiag-socket', daemon=True)
+    worker.start()
+    return worker
+
+# -----------------------------------------------------------------------------
+# socket_query(path, subsystems, max_age)
+# -----------------------------------------------------------------------------
+def socket_query(path=DEFAULT_SOCKET, subsystems='all', max_age=None, timeout=60.0):
+    """ask a running query server for a snapshot, returns the dictionary;
+       raises OSError if there's no server, ValueError on a cut-off reply
+    """
+    request = subsystems
+    if max_age is not None:
+        request += ' ' + str(max_age)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(request.encode('utf-8') + b'\n')
+        work = b''
+        while not work.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if len(chunk) == 0:
+                break
+            work += chunk
+    finally:
+        sock.close()
+
+    return json.loads(work.decode('utf-8'))
+
+# -----------------------------------------------------------------------------
+# class SshTransport
+# -----------------------------------------------------------------------------
+class SshTransport:
+    """Runs sysdiag on a remote host over ssh, reusing one multiplexed
+       connection per host (ControlMaster) across runs
+    """
+    # -----------------------------------------------------------------------------
+    # __init__(remote_cmd)
+    # -----------------------------------------------------------------------------
+    def __init__(self, remote_cmd='python3 sysdiag.py'):
+        self.remote_cmd = remote_cmd
+
+    # -----------------------------------------------------------------------------
+    # command(host, args)
+    # -----------------------------------------------------------------------------
+    def command(self, host, args):
+        """the argv that collects from host, args go to the remote sysdiag
+        """
+        return ['/usr/bin/ssh', '-o', 'BatchMode=yes', \
+                '-o', 'ControlMaster=auto', \
+                '-o', 'ControlPath=~/.ssh/sysdiag-%r@%h:%p', \
+                '-o', 'ControlPersist=300', \
+                host, self.remote_cmd + ' ' + ' '.join(args)]
+
+# -----------------------------------------------------------------------------
+# class LocalTransport
+# -----------------------------------------------------------------------------
+class LocalTransport:
+    """Stand-in transport that runs this sysdiag locally for every host,
+       for trying out fleet mode without touching the network
+    """
+    # -----------------------------------------------------------------------------
+    # __init__(remote_cmd)
+    # -----------------------------------------------------------------------------
+    def __init__(self, remote_cmd=''):
+        self.remote_cmd = remote_cmd
+
+    # -----------------------------------------------------------------------------
+    # command(host, args)
+    # -----------------------------------------------------------------------------
+    def command(self, host, args):
+        """the argv that 'collects from' host
+        """
+        if self.remote_cmd != '':
+            return self.remote_cmd.split() + args
+        return [sys.executable, os.path.abspath(__file__)] + args
+
+# transports --fleet knows about:
+FLEET_TRANSPORTS = {'ssh': SshTransport, 'local': LocalTransport}
+
+# the most --aggregate buffers for one multi-line document:
+AGGREGATE_MAX_DOC = 16 * 1024 * 1024
+
+# -----------------------------------------------------------------------------
+# fleet_host(transport, host, args, timeout, limit)
+# -----------------------------------------------------------------------------
+async def fleet_host(transport, host, args, timeout, limit):
+    """collect from one host, returns its result record
+    """
+    async with limit:
+        started = time.time()
+        record = {'host': host, 'ok': False}
+        try:
+            proc = await asyncio.create_subprocess_exec(*transport.command(host, args), \
+                    stdin=asyncio.subprocess.DEVNULL, \
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, \
+                    start_new_session=True)
+        except OSError as error:
+            record['error'] = str(error)
+            record['elapsed'] = time.time() - started
+            return record
+
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError as error:
+            # kill the whole group, or a child holding the pipes keeps us waiting:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError as error:
+                pass
+            await proc.wait()
+            record['error'] = 'timed out after {:g}s'.format(timeout)
+            record['elapsed'] = time.time() - started
+            return record
+
+        record['elapsed'] = time.time() - started
+        if proc.returncode != 0:
+            record['error'] = 'exit ' + str(proc.returncode) + ': ' + \
+                    err.decode('utf-8', 'replace').strip()[-500:]
+            return record
+
+        try:
+            record['snapshot'] = json.loads(out.decode('utf-8'))
+            record['ok'] = True
+        except ValueError as error:
+            record['error'] = 'bad json: ' + str(error)
+        return record
+
+# -----------------------------------------------------------------------------
+# fleet_run(hosts, transport, args, concurrency, timeout)
+# -----------------------------------------------------------------------------
+async def fleet_run(hosts, transport, args, concurrency=50, timeout=60.0):
+    """collect from all the hosts, at most concurrency at a time,
+       writing each result as an ndjson line as soon as it comes in;
+       returns (hosts that worked, hosts that didn't)
+    """
+    limit = asyncio.Semaphore(concurrency)
+    tasks = [fleet_host(transport, host, args, timeout, limit) for host in hosts]
+
+    good = 0
+    bad = 0
+    for task in asyncio.as_completed(tasks):
+        record = await task
+        sys.stdout.write(json.dumps(record, separators=(',', ':')) + '\n')
+        sys.stdout.flush()
+        if record['ok']:
+            good += 1
+        else:
+            bad += 1
+
+    return good, bad
+
+# -----------------------------------------------------------------------------
+# fleet_hosts(path)
+# -----------------------------------------------------------------------------
+def fleet_hosts(path):
+    """read a host list: one host per line, blank lines and # comments skipped
+    """
+    hosts = []
+    with open(path, 'r') as inp:
+        for line in inp.readlines():
+            line = line.split('#')[0].strip()
+            if len(line) > 0:
+                hosts.append(line.split()[0])
+    return hosts
+
+# -----------------------------------------------------------------------------
+# class TopN
+# -----------------------------------------------------------------------------
+class TopN:
+    """Keeps the n highest-scoring items seen, in a heap of size n
+    """
+    # -----------------------------------------------------------------------------
+    # __init__(n)
+    # -----------------------------------------------------------------------------
+    def __init__(self, n):
+        self.n = n
+        self.heap = []
+        self.counter = itertools.count()  # so equal scores never compare items
+
+    # -----------------------------------------------------------------------------
+    # push(score, item)
+    # -----------------------------------------------------------------------------
+    def push(self, score, item):
+        entry = (score, next(self.counter), item)
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, entry)
+        elif score > self.heap[0][0]:
+            heapq.heapreplace(self.heap, entry)
+
+    # -----------------------------------------------------------------------------
+    # items()
+    # -----------------------------------------------------------------------------
+    def items(self):
+        """(score, item) pairs, highest score first
+        """
+        return [(x[0], x[2]) for x in sorted(self.heap, reverse=True)]
+
+# -----------------------------------------------------------------------------
+# class FleetAggregate
+# -----------------------------------------------------------------------------
+class FleetAggregate:
+    """Streaming summary of many hosts' snapshots: counts, plus the
+       top_n worst hosts for each metric, in memory that doesn't grow
+       with the number of snapshots
+    """
+    # -----------------------------------------------------------------------------
+    # __init__(top_n)
+    # -----------------------------------------------------------------------------
+    def __init__(self, top_n=10):
+        self.snapshots = 0
+        self.failed = 0
+        self.services_down = 0
+        self.services_total = 0
+        self.disks_stale = 0
+        self.failures = TopN(top_n)
+        self.disks = TopN(top_n)
+        self.memory = TopN(top_n)
+        self.cpus = TopN(top_n)
+        self.net_errors = TopN(top_n)
+        self.services = TopN(top_n)
+
+    # -----------------------------------------------------------------------------
+    # add(record)
+    # -----------------------------------------------------------------------------
+    def add(self, record):
+        """take one --fleet record, or a bare --format json snapshot;
+           raises on a malformed one without having counted any of it
+        """
+        if 'snapshot' in record or 'ok' in record:
+            host = record.get('host', '?')
+            if not record.get('ok', False):
+                self.failed += 1
+                self.failures.push(-self.failed, (host, record.get('error', '')))
+                return
+            snap = record['snapshot']
+        else:
+            snap = record
+            host = snap.get('host', snap.get('system_name', '?'))
+
+        # pick everything out before counting anything, so a malformed
+        # record raises with the totals untouched:
+        disks = []
+        stale = 0
+        for mount, d in snap.get('disks', {}).items():
+            if d.get('stale'):
+                stale += 1
+            if 'usep' in d:
+                disks.append((float(d['usep']), (host, mount, d['free'])))
+
+        memory = None
+        m = snap.get('memory', {})
+        if m.get('total', 0) > 0:
+            memory = (-100.0 * m['available'] / m['total'], (host, m['available'], m['total']))
+
+        cpus = None
+        if 'all' in snap.get('cpus', {}):
+            cpus = (100.0 - snap['cpus']['all']['%idle'], (host, snap['cpus']['all']['%iowait']))
+
+        net = []
+        for iface, d in snap.get('network', {}).items():
+            if 'counters' in d:
+                c = d['counters']
+                errors = sum([c.get(k, 0) for k in ['rx_errors', 'tx_errors', 'rx_dropped', 'tx_dropped']])
+                net.append((errors, (host, iface)))
+
+        services = snap.get('services', {})
+        down = [svc for svc, x in services.items() if x[0] != 'active' or x[1] != '(running)']
+
+        self.snapshots += 1
+        self.disks_stale += stale
+        for score, item in disks:
+            self.disks.push(score, item)
+        if memory is not None:
+            self.memory.push(*memory)
+        if cpus is not None:
+            self.cpus.push(*cpus)
+        for score, item in net:
+            self.net_errors.push(score, item)
+        self.services_total += len(services)
+        self.services_down += len(down)
+        if len(down) > 0:
+            self.services.push(len(down), (host, down[:5]))
+
+    # -----------------------------------------------------------------------------
+    # summary()
+    # -----------------------------------------------------------------------------
+    def summary(self):
+        """the aggregate as a dictionary
+        """
+        out = dict()
+        out['snapshots'] = self.snapshots
+        out['failed'] = self.failed
+        out['disks_stale'] = self.disks_stale
+        out['services_total'] = self.services_total
+        out['services_down'] = self.services_down
+        out['failures'] = [{'host': x[0], 'error': x[1]} for s, x in self.failures.items()]
+        out['fullest_disks'] = [{'host': x[0], 'mount': x[1], 'usep': s, 'free': x[2]} \
+                for s, x in self.disks.items()]
+        out['lowest_memory'] = [{'host': x[0], 'available_pct': -s, 'available': x[1], 'total': x[2]} \
+                for s, x in self.memory.items()]
+        out['busiest_cpus'] = [{'host': x[0], 'busy': s, 'iowait': x[1]} for s, x in self.cpus.items()]
+        out['most_net_errors'] = [{'host': x[0], 'interface': x[1], 'errors': s} \
+                for s, x in self.net_errors.items() if s > 0]
+        out['most_services_down'] = [{'host': x[0], 'down': s, 'services': x[1]} \
+                for s, x in self.services.items()]
+        return out
+
+# -----------------------------------------------------------------------------
+# json_records(inp)
+# -----------------------------------------------------------------------------
+def json_records(inp):
+    """stream the JSON documents out of inp: one per line (ndjson), or
+       indented over several lines (--format json), or the elements of
+       a JSON array (read whole, ndjson is what scales). Anything that
+       won't parse comes back as a failed record rather than stopping us.
+       A multi-line document is decoded once, when a line at column 0
+       closes it, and gives up after AGGREGATE_MAX_DOC bytes
+    """
+    decoder = json.JSONDecoder()
+    pending = []        # lines of the multi-line document that's open
+    size = 0
+    skipping = False    # dropping the rest of an oversized document
+
+    def bad(why):
+        return {'host': '?', 'ok': False, 'error': 'bad record: ' + why}
+
+    for line in inp:
+        text = line.strip()
+        if len(text) == 0:
+            continue
+
+        if skipping:
+            skipping = line[0] not in '}]'
+            continue
+
+        if len(pending) == 0:
+            try:
+                doc = json.loads(text)
+            except ValueError as error:
+                if error.pos < len(text):
+                    yield bad(str(error))
+                else:
+                    pending = [line]    # ran off the end, may go on next line
+                    size = len(line)
+                continue
+        else:
+            # a whole record on one line, or a new document starting at
+            # column 0, means what's open was a cut-off line:
+            doc = None
+            if text[0] == '{' and text[-1] == '}':
+                try:
+                    doc = json.loads(text)
+                except ValueError as error:
+                    doc = None
+            if (isinstance(doc, dict) and len(doc) > 0) or line.rstrip() in ['{', '[']:
+                yield bad('truncated: ' + pending[0].strip()[:40])
+                pending = []
+                if doc is None:
+                    pending = [line]
+                    size = len(line)
+                    continue
+            else:
+                pending.append(line)
+                size += len(line)
+                if size > AGGREGATE_MAX_DOC:
+                    yield bad('document over ' + str(AGGREGATE_MAX_DOC) + ' bytes')
+                    pending = []
+                    skipping = line[0] not in '}]'
+                    continue
+                if line[0] not in '}]':
+                    continue
+
+                # the closing line of an indented document, decode it all at once:
+                work = ''.join(pending)
+                pending = []
+                try:
+                    doc, end = decoder.raw_decode(work, len(work) - len(work.lstrip()))
+                except ValueError as error:
+                    yield bad(str(error))
+                    continue
+                if len(work[end:].strip()) > 0:
+                    yield bad('extra data after document')
+
+        if isinstance(doc, list):
+            for x in doc:
+                yield x
+        else:
+            yield doc
+
+    if len(pending) > 0:
+        yield bad('truncated at end of input: ' + pending[0].strip()[:40])
+
+# -----------------------------------------------------------------------------
+# aggregate_print(summary)
+# -----------------------------------------------------------------------------
+def aggregate_print(summary):
+    """pretty-print a FleetAggregate summary
+    """
+    print('Fleet:', summary['snapshots'], 'snapshots,', summary['failed'], 'hosts failed,', \
+            summary['disks_stale'], 'stale disks,', summary['services_down'], 'of', \
+            summary['services_total'], 'services down')
+    print()
+
+    if len(summary['failures']) > 0:
+        print('Failed hosts:')
+        for x in summary['failures']:
+            print('    ' + x['host'].ljust(30), x['error'][:60])
+        print()
+
+    print('Fullest disks:')
+    for x in summary['fullest_disks']:
+        print('    ' + x['host'].ljust(30) + x['mount'].ljust(16) + \
+                '{:3.1f}%'.format(x['usep']).rjust(7) + Diag.humanize(x['free']).rjust(9) + ' free')
+    print()
+
+    print('Lowest available memory:')
+    for x in summary['lowest_memory']:
+        print('    ' + x['host'].ljust(30) + '{:3.1f}%'.format(x['available_pct']).rjust(7) + \
+                Diag.humanize(x['available']).rjust(9) + ' of ' + Diag.humanize(x['total']))
+    print()
+
+    print('Busiest CPUs:')
+    for x in summary['busiest_cpus']:
+        print('    ' + x['host'].ljust(30) + '{:3.1f}% busy'.format(x['busy']).rjust(12) + \
+                '{:3.1f}% iowait'.format(x['iowait']).rjust(14))
+    print()
+
+    print('Most interface errors:')
+    for x in summary['most_net_errors']:
+        print('    ' + x['host'].ljust(30) + x['interface'].ljust(16) + str(x['errors']).rjust(10))
+    print()
+
+    print('Most services down:')
+    for x in summary['most_services_down']:
+        print('    ' + x['host'].ljust(30) + str(x['down']).rjust(4) + '  ' + ', '.join(x['services']))
+    print()
+
+# -----------------------------------------------------------------------------
+# prom_labels(labels)
+# -----------------------------------------------------------------------------
+def prom_labels(labels):
+    """format a dictionary as {name="value",...}, escaped for Prometheus
+    """
+    if len(labels) == 0:
+        return ''
+    parts = []
+    for k in labels:
+        v = str(labels[k]).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(k + '="' + v + '"')
+    return '{' + ','.join(parts) + '}'
+
+# -----------------------------------------------------------------------------
+# prom_render(snap)
+# -----------------------------------------------------------------------------
+def prom_render(snap):
+    """render a snapshot in the Prometheus text exposition format
+    """
+    metrics = dict()    # name: (type, help, [(labels, value)])
+
+    def add(name, kind, text, labels, value):
+        if value is None:
+            return
+        if name not in metrics:
+            metrics[name] = (kind, text, [])
+        metrics[name][2].append((labels, value))
+
+    for mount, d in snap.get('disks', {}).items():
+        m = {'mount': mount}
+        add('sysdiag_disk_stale', 'gauge', '1 if the mount did not answer statvfs', m, int(d['stale']))
+        if 'size' in d:
+            add('sysdiag_disk_size_bytes', 'gauge', 'filesystem size', m, d['size'])
+            add('sysdiag_disk_used_bytes', 'gauge', 'filesystem space used', m, d['used'])
+            add('sysdiag_disk_free_bytes', 'gauge', 'filesystem space free', m, d['free'])
+            add('sysdiag_disk_used_percent', 'gauge', 'filesystem percent used', m, d['usep'])
+        if d.get('io') is not None:
+            add('sysdiag_disk_iops', 'gauge', 'reads and writes per second', m, d['io']['iops'])
+            add('sysdiag_disk_throughput_bytes_per_second', 'gauge', \
+                    'bytes read and written per second', m, d['io']['MB/s'] * 1000000.0)
+            add('sysdiag_disk_await_milliseconds', 'gauge', 'average I/O wait', m, d['io']['await'])
+            add('sysdiag_disk_util_percent', 'gauge', 'percent of time the device was busy', \
+                    m, d['io']['%util'])
+
+    for cpu, d in snap.get('cpus', {}).items():
+        for k in d:
+            if k.startswith('%'):
+                add('sysdiag_cpu_percent', 'gauge', 'CPU time by mode', \
+                        {'cpu': cpu, 'mode': k[1:]}, d[k])
+
+    for k, v in snap.get('memory', {}).items():
+        if not k.startswith('hugepages_'):
+            add('sysdiag_memory_bytes', 'gauge', 'memory by kind', {'kind': k}, v)
+    for k, v in snap.get('swapinfo', {}).items():
+        add('sysdiag_swap_bytes', 'gauge', 'swap by kind', {'kind': k}, v)
+
+    for iface, d in snap.get('network', {}).items():
+        m = {'interface': iface}
+        add('sysdiag_network_up', 'gauge', '1 if the interface is up', m, int(d['operstate'] == 'up'))
+        for k, v in d.get('counters', {}).items():
+            add('sysdiag_network_' + k + '_total', 'counter', 'from /sys/class/net statistics', m, v)
+
+    for host, d in snap.get('netping', {}).items():
+        m = {'host': host}
+        add('sysdiag_ping_up', 'gauge', '1 if the host answered a ping', m, int(d['rtt'] is not None))
+        add('sysdiag_ping_rtt_milliseconds', 'gauge', 'ping round trip time', m, d['rtt'])
+
+    for svc, x in snap.get('services', {}).items():
+        info = snap.get('services_info', {}).get(svc, {})
+        m = {'service': svc}
+        add('sysdiag_service_up', 'gauge', '1 if the service is active and running', \
+                {'service': svc, 'state': x[0], 'substate': x[1].strip('()')}, \
+                int(x[0] == 'active' and x[1] == '(running)'))
+        add('sysdiag_service_restarts', 'gauge', 'systemd NRestarts', m, info.get('NRestarts'))
+        add('sysdiag_service_memory_bytes', 'gauge', 'systemd MemoryCurrent', m, info.get('MemoryCurrent'))
+
+    p = snap.get('procs', {})
+    if 'count' in p:
+        add('sysdiag_processes', 'gauge', 'processes running', {}, p['count'])
+        add('sysdiag_threads', 'gauge', 'threads running', {}, p['threads'])
+        for x in p['cpu']:
+            add('sysdiag_process_cpu_percent', 'gauge', 'top processes by CPU', \
+                    {'pid': str(x['pid']), 'name': x['name']}, x['cpu'])
+        for x in p['rss']:
+            add('sysdiag_process_resident_bytes', 'gauge', 'top processes by resident memory', \
+                    {'pid': str(x['pid']), 'name': x['name']}, x['rss'])
+
+    for name in snap.get('timed_out', {}):
+        add('sysdiag_collector_timed_out', 'gauge', '1 if the collector ran out of time', \
+                {'subsystem': name}, 1)
+
+    add('sysdiag_snapshot_timestamp_seconds', 'gauge', 'when the snapshot was taken', {}, snap['ts'])
+
+    lines = []
+    for name in metrics:
+        kind, text, values = metrics[name]
+        lines.append('# HELP ' + name + ' ' + text)
+        lines.append('# TYPE ' + name + ' ' + kind)
+        for labels, value in values:
+            lines.append(name + prom_labels(labels) + ' ' + repr(float(value)))
+    return '\n'.join(lines) + '\n'
+
+# -----------------------------------------------------------------------------
+# class MetricsHandler
+# -----------------------------------------------------------------------------
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Answers GET /metrics from the server's SnapshotCache
+    """
+    # -----------------------------------------------------------------------------
+    # do_GET()
+    # -----------------------------------------------------------------------------
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+
+        body = prom_render(self.server.cache.get()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # -----------------------------------------------------------------------------
+    # log_message()
+    # -----------------------------------------------------------------------------
+    def log_message(self, format, *args):
+        pass # scrapes every few seconds would just be noise
+
+# -----------------------------------------------------------------------------
+# serve(cache, address)
+# -----------------------------------------------------------------------------
+def serve(cache, address):
+    """start the metrics endpoint on address ('host:port' or ':port')
+       in a background thread, returns the server
+    """
+    host, port = address.rsplit(':', 1)
+    server = http.server.ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    server.daemon_threads = True
+    server.cache = cache
+    worker = threading.Thread(target=server.serve_forever, name='sysdiag-serve', daemon=True)
+    worker.start()
+    return server
+
+# -----------------------------------------------------------------------------
+# unit_type(path)
+# -----------------------------------------------------------------------------
+def unit_type(path):
+    """the Type= of a systemd unit file, '' if it's masked or unreadable
+    """
+    if path == '/dev/null':
+        return ''
+
+    utype = 'simple'
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('Type='):
+                    utype = line[5:].strip()
+    except (IOError, OSError) as error:
+        return ''
+
+    return utype
+
+# -----------------------------------------------------------------------------
+# services_discover()
+# -----------------------------------------------------------------------------
+def services_discover():
+    """find the services enabled at boot without asking systemctl,
+       returns {'systemd', 'sysv', 'viya', 'aggregate'} sorted name lists
+    """
+    found = {'systemd': set(), 'sysv': set(), 'viya': set(), 'aggregate': set()}
+
+    # systemctl enable leaves a symlink in some target's .wants directory:
+    units = set()
+    for link in glob.glob(SYSTEMD_WANTS):
+        # bare names like the rest of the .ini, '.service' is implied:
+        name = os.path.basename(link)[:-8]
+        units.add(name)
+
+        # templates, and oneshot helpers that are never 'running':
+        if '@' in name or unit_type(os.path.realpath(link)) in ['', 'oneshot']:
+            continue
+
+        if name in VIYA_AGGREGATES:
+            found['aggregate'].add(name)
+        elif VIYA_UNIT.match(name):
+            found['viya'].add(name)
+        else:
+            found['systemd'].add(name)
+
+    # init scripts count if they start in runlevel 3, and systemd doesn't own them:
+    for rcdir in SYSV_RC_DIRS:
+        for link in glob.glob(rcdir + '/S[0-9][0-9]*'):
+            name = os.path.basename(link)[3:]
+            if name in SYSV_SKIP or name.endswith('.sh') or name in units:
+                continue
+
+            if name in VIYA_AGGREGATES:
+                found['aggregate'].add(name)
+            elif VIYA_UNIT.match(name):
+                found['viya'].add(name)
+            else:
+                found['sysv'].add(name)
+
+    for key in found:
+        found[key] = sorted(found[key])
+
+    return found
+
 # -----------------------------------------------------------------------------
 # create the .ini file:
 # -----------------------------------------------------------------------------
@@ -415,85 +2920,292 @@ def create_ini():
     """
 
     # --- system name:
-    sysname = subprocess.check_output(['/usr/bin/hostname'], \
-            stderr=subprocess.STDOUT)
-    sysname = sysname.decode('utf-8')
-    sysname = sysname.rstrip() # single-line response needs rstrip()
+    sysname = os.uname().nodename
 
     print('# sysdiag.ini:')
     print()
     print('system_name', sysname)
     print()
 
-    # --- disks:
+    # --- disks, straight from the mount table so a dead NFS server can't hang us:
     print('# disks: please edit:')
-    disklines = subprocess.check_output(['/usr/bin/df'], \
-            stderr=subprocess.STDOUT)
-    disklinesarray = disklines.splitlines()
-    disklines = []
-    for line in disklinesarray:
-        disklines.append(line.decode('utf-8'))
-
-    for line in disklines:
-        if 'tmpfs' in line:
-            continue;
-
-        parts = line.split()
-        if len(parts) != 6:
-            continue;
+    seen = set()
+    for m in mountinfo():
+        if m['fstype'] in PSEUDO_FS or m['mount'] in seen:
+            continue
+        seen.add(m['mount'])
 
-        print('disk', parts[5])
+        print('disk', m['mount'])
     print()
 
-    # --- network interface:
-    netlines = subprocess.check_output(['/usr/sbin/ifconfig'], \
-            stderr=subprocess.STDOUT)
-    netlinesarray = netlines.splitlines()
-    netlines = []
-    for line in netlinesarray:
-        netlines.append(line.decode('utf-8'))
-
+    # --- network interfaces that are up:
     counter = 0
     outlines = ''
-    for line in netlines:
-        if 'RUNNING' in line:
-            parts = line.split()
-            if parts[0] != 'lo:':
-                outlines += 'network ' + str(parts[0][:-1]) + '\n'
-                counter += 1
+    for sysdir in sorted(glob.glob('/sys/class/net/*/')):
+        iface = os.path.basename(sysdir.rstrip('/'))
+        if iface == 'lo':
+            continue
+
+        try:
+            state = proc_read(sysdir + 'operstate').strip()
+        except (IOError, OSError) as error:
+            continue
+
+        if state == 'up':
+            outlines += 'network ' + iface + '\n'
+            counter += 1
 
     if counter == 0:
         print('# !!! no running network interfaces found !!!')
         print()
-    elif counter > 1:
-        print('# network: choose one:')
-        print(outlines)
     else:
-        print('# network:')
+        print('# network: please edit:')
         print(outlines)
 
-    # --- available services:
-    print('# services: please edit:')
-    print('#')
-    print('# from /etc/init.d:')
-
-    svclines = glob.glob('/etc/init.d/*')
-    for svc in svclines:
-        if len(svc) > 0:
-            print('service', os.path.basename(svc))
+    # --- enabled services:
+    found = services_discover()
+    print('# services: enabled at boot, please check:')
+    for title, key in [('/etc/systemd/system/*.wants', 'systemd'), ('/etc/rc3.d', 'sysv'), \
+            ('SAS Viya', 'viya')]:
+        print('#')
+        print('# ' + title + ':')
+        for svc in found[key]:
+            print('service', svc)
 
-    svclines = glob.glob('/etc/systemd/system/*.service')
-    print('#')
-    print('# from /etc/systemd/system:')
-    for svc in svclines:
-        if len(svc) > 0:
-            print('service', os.path.basename(svc))
+    # the aggregates just start and stop the others, probing them tells us nothing:
+    for svc in found['aggregate']:
+        print('#service', svc)
 
     print()
 
     # --- the end:
     print('# EOF:')
 
+# -----------------------------------------------------------------------------
+# report(diag, lclhost, sections, full)
+# -----------------------------------------------------------------------------
+def report(diag, lclhost, sections, full):
+    """print the report for the given sections of a Diag,
+       full adds the disk count and network interface
+    """
+    if diag.sysname != lclhost:
+        # we can do better here with proper string formatting:
+        print("system_name entry '" + diag.sysname + \
+                "' not the same as '" + lclhost + "'")
+    else:
+        print('system:    ', diag.sysname)
+
+    print('OS version:', diag.os_version)
+    print('uptime:    ', diag.uptime)
+    print('date/time: ', diag.datestamp)
+    print()
+
+    # only do these on a full output:
+    if full == True:
+        print('disk_count:', diag.disk_count)
+        print('network:   ', diag.net_interface)
+        print()
+
+    if 'disks' in sections:
+        print('Disks:')
+        diag.disk_print()
+        print()
+
+    if 'cpus' in sections:
+        print('CPU loads:')
+        diag.cpus_print()
+        print()
+
+    if 'memory' in sections:
+        print('Memory and Swap space:')
+        diag.swapmem_print()
+        print()
+
+    if 'network' in sections:
+        print('Network info:')
+        diag.network_print()
+        print()
+
+    if 'netping' in sections:
+        diag.need('netping')
+        print('Sysping:', end=' ')
+        if 'netping' in diag.timed_out or 'netping' in diag.failed:
+            print()
+            diag.not_collected('netping')
+        elif len(diag.netping_lines) == 0:
+            print('OK')
+        else:
+            print()
+            for l in diag.netping_lines:
+                print(l)
+        print()
+
+    if 'procs' in sections:
+        print('Top processes:')
+        diag.procs_print()
+        print()
+
+    if 'services' in sections:
+        diag.need('services')
+        print('Services:')
+        if not diag.not_collected('services'):
+            svccount = len(diag.services)
+            running   = svccount
+            notrunning = 0
+
+            for svc in diag.services:
+                x = diag.services[svc]
+                if x[0] != 'active' or x[1] != '(running)':
+                    print('    ' + svc + ':', diag.services[svc])
+                    if not os.path.isfile("/var/run/sas" + svc):
+                        print('   !' + svc + ': pid file missing')
+                    notrunning += 1
+
+            if notrunning == 0:
+                print('    all', str(running) + ' services are running')
+            else:
+                print()
+                if notrunning == 1:
+                    print('    1 service is down')
+                else:
+                    print('   ', notrunning, 'services are down')
+
+                print('   ', running, 'services are running')
+
+        print()
+
+    print()
+
+# -----------------------------------------------------------------------------
+# output(diag, lclhost, sections, full, fmt)
+# -----------------------------------------------------------------------------
+def output(diag, lclhost, sections, full, fmt):
+    """print the report, or write the snapshot as json/ndjson,
+       json output goes out in one write
+    """
+    if fmt == 'text':
+        report(diag, lclhost, sections, full)
+        sys.stdout.flush()
+        return
+
+    snap = diag.snapshot(sections)
+    snap['host'] = lclhost
+    if fmt == 'ndjson':
+        work = json.dumps(snap, separators=(',', ':'))
+    else:
+        work = json.dumps(snap, indent=2)
+
+    sys.stdout.write(work + '\n')
+    sys.stdout.flush()
+
+# -----------------------------------------------------------------------------
+# history_print(store, metric, host, since)
+# -----------------------------------------------------------------------------
+def history_print(store, metric, host, since):
+    """print the stored samples of a metric from the last since seconds,
+       long ranges come from the rollups
+    """
+    res, rows = store.query_range(metric, host, time.time() - since)
+    if len(rows) == 0:
+        print('no samples of', metric, 'for', host)
+        return
+
+    if res == 0:
+        for ts, low, high, avg, count in rows:
+            print(datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'), \
+                    '{:.2f}'.format(avg))
+    else:
+        print('{}s buckets:            min:      max:      avg:'.format(res))
+        for ts, low, high, avg, count in rows:
+            print(datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'), \
+                    '{:9.2f} {:9.2f} {:9.2f}'.format(low, high, avg))
+
+    count = sum([x[4] for x in rows])
+    print('{} samples, min {:.2f} max {:.2f} avg {:.2f}'.format(count, \
+            min([x[1] for x in rows]), max([x[2] for x in rows]), \
+            sum([x[3] * x[4] for x in rows]) / count))
+
+# -----------------------------------------------------------------------------
+# segments_print(directory, metric, since)
+# -----------------------------------------------------------------------------
+def segments_print(directory, metric, since):
+    """print a metric's samples from the last since seconds out of segment files
+    """
+    count = 0
+    low = high = total = 0.0
+    for ts, value in segments_read(directory, metric, time.time() - since):
+        print(datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'), \
+                '{:.2f}'.format(value))
+        if count == 0:
+            low = high = value
+        low = min(low, value)
+        high = max(high, value)
+        total += value
+        count += 1
+
+    if count == 0:
+        print('no samples of', metric, 'in', directory)
+        return
+
+    print('{} samples, min {:.2f} max {:.2f} avg {:.2f}'.format(count, \
+            low, high, total / count))
+
+# -----------------------------------------------------------------------------
+# watch(diag, lclhost, sections, full, interval, store, segments, fmt, cache, publisher)
+# -----------------------------------------------------------------------------
+def watch(diag, lclhost, sections, full, interval, store=None, segments=None, \
+        fmt='text', cache=None, publisher=None):
+    """keep refreshing the Diag and printing reports every interval seconds,
+       on a fixed schedule so the samples don't drift;
+       each sample also goes to the HistoryStore and SegmentWriter if we have them,
+       through the SnapshotCache if there is one (so servers see it),
+       and to the ShmPublisher if there is one
+    """
+    global g_keep_open
+    g_keep_open = True
+
+    # a scrape can refresh the Diag from a server thread, only read it under
+    # the cache's lock (our own lock is just there to keep one code path):
+    lock = cache.lock if cache is not None else threading.Lock()
+
+    # keep a day's worth of samples in memory:
+    with lock:
+        diag.history = History(int(math.ceil(86400.0 / interval)))
+        diag.history.add(time.time(), diag.samples())
+
+    start = time.time()
+    tick = 0
+    while True:
+        with lock:
+            if store is not None:
+                store.add(lclhost, diag.history.ts[-1], diag.samples())
+            if segments is not None:
+                segments.add(diag.history.ts[-1], diag.samples())
+            if publisher is not None:
+                publisher.publish(cache.text, cache.taken)
+
+            output(diag, lclhost, sections, full, fmt)
+
+        # sleep until the next tick, skip any we've already missed:
+        tick += 1
+        now = time.time()
+        if start + tick * interval < now:
+            tick = int((now - start) / interval) + 1
+        time.sleep(start + tick * interval - now)
+
+        if cache is not None:
+            cache.refresh()
+        else:
+            diag.refresh(sections)
+
+# -----------------------------------------------------------------------------
+# terminate(signum, frame)
+# -----------------------------------------------------------------------------
+def terminate(signum, frame):
+    """SIGTERM handler, shut down the way we do for Ctrl-C
+    """
+    raise KeyboardInterrupt()
+
 # -----------------------------------------------------------------------------
 # main part of the program:
 # -----------------------------------------------------------------------------
@@ -502,13 +3214,28 @@ if __name__ == '__main__':
        If they give us anything else, print a usage message.
        Otherwise, create a Diag instance and display what we find.
     """
-    fl_cpu = True
-    fl_dsk = True
-    fl_mem = True
-    fl_net = True
-    fl_png = True
-    fl_svc = True
-    fl_ful = True
+    flags = []
+    interval = 0
+    db_path = ''
+    seg_dir = ''
+    history = ''
+    since = 86400.0
+    fmt = 'text'
+    serve_addr = ''
+    min_refresh = 15.0
+    shm_path = DEFAULT_SHM
+    shm_publish = False
+    shm_read_only = False
+    sock_path = ''
+    query = ''
+    max_age = None
+    fleet = ''
+    transport = 'ssh'
+    remote_cmd = ''
+    fleet_workers = 50
+    fleet_timeout = 60.0
+    aggregate = ''
+    top_n = 10
 
     iam = sys.argv.pop(0)
 
@@ -526,134 +3253,273 @@ if __name__ == '__main__':
             g_ini_file = sys.argv.pop(0)
             continue
 
+        # if they want us to keep running:
+        if arg == '--watch':
+            interval = float(sys.argv.pop(0))
+            continue
+
+        # text report, or json for other programs:
+        if arg == '--format':
+            fmt = sys.argv.pop(0)
+            if fmt not in ['text', 'json', 'ndjson']:
+                print(iam + ': --format is text, json or ndjson')
+                sys.exit(1)
+            continue
+
+        # Prometheus metrics endpoint:
+        if arg == '--serve':
+            serve_addr = sys.argv.pop(0)
+            continue
+
+        if arg == '--min-refresh':
+            min_refresh = float(sys.argv.pop(0))
+            continue
+
+        # shared-memory snapshot:
+        if arg == '--shm':
+            shm_path = sys.argv.pop(0)
+            continue
+
+        if arg == '--publish-shm':
+            shm_publish = True
+            continue
+
+        if arg == '--read-shm':
+            shm_read_only = True
+            continue
+
+        # unix socket query server and client:
+        if arg == '--socket':
+            sock_path = sys.argv.pop(0)
+            continue
+
+        if arg == '--query':
+            query = sys.argv.pop(0)
+            continue
+
+        if arg == '--max-age':
+            max_age = float(sys.argv.pop(0))
+            continue
+
+        # collect from a list of hosts:
+        if arg == '--fleet':
+            fleet = sys.argv.pop(0)
+            continue
+
+        if arg == '--transport':
+            transport = sys.argv.pop(0)
+            if transport not in FLEET_TRANSPORTS:
+                print(iam + ': --transport is one of', ', '.join(FLEET_TRANSPORTS))
+                sys.exit(1)
+            continue
+
+        if arg == '--remote-cmd':
+            remote_cmd = sys.argv.pop(0)
+            continue
+
+        if arg == '--fleet-workers':
+            fleet_workers = int(sys.argv.pop(0))
+            continue
+
+        if arg == '--fleet-timeout':
+            fleet_timeout = float(sys.argv.pop(0))
+            continue
+
+        # summarize --fleet output:
+        if arg == '--aggregate':
+            aggregate = sys.argv.pop(0)
+            continue
+
+        if arg == '--top':
+            top_n = int(sys.argv.pop(0))
+            continue
+
+        # sample history:
+        if arg == '--db':
+            db_path = sys.argv.pop(0)
+            continue
+
+        if arg == '--segments':
+            seg_dir = sys.argv.pop(0)
+            continue
+
+        if arg == '--history':
+            history = sys.argv.pop(0)
+            continue
+
+        if arg == '--since':
+            since = parse_duration(sys.argv.pop(0))
+            continue
+
         # do the help thing:
         if arg == '-h' or arg == '-?' or arg == '--help':
             print(iam, 'usage:')
             print('    --create to output a new .ini file')
             print('    -i <alternate ini file> to use a different .ini file')
+            print('    --watch <seconds> to keep reporting every so many seconds')
+            print('    --format text|json|ndjson for the output format (default text)')
+            print('    --serve [host]:port to serve Prometheus metrics on /metrics')
+            print('    --min-refresh <seconds> to collect at most that often for --serve (default 15)')
+            print('    --publish-shm to publish each --watch sample in shared memory')
+            print('    --read-shm to print the latest published sample as json')
+            print('    --shm <file> for a shared memory file other than ' + DEFAULT_SHM)
+            print('    --socket <path> to answer snapshot queries on a unix socket')
+            print('    --query <subsystems|all> [--max-age <seconds>] to ask that server,')
+            print('        e.g. --query disks,services (default socket ' + DEFAULT_SOCKET + ')')
+            print('    --fleet <hostlist> to collect from every host in the list, as ndjson')
+            print('        --transport ssh|local (default ssh), --remote-cmd <command>')
+            print('        --fleet-workers <n> at once (default 50), --fleet-timeout <seconds> (default 60)')
+            print('    --aggregate <file|-> [--top <n>] to summarize --fleet output (default top 10)')
+            print('    --db <file> to record --watch samples in a history database')
+            print('    --segments <dir> to record --watch samples in compressed segment files')
+            print('    --history <metric> [--since 1h] to show recorded samples')
+            print('        (from --segments <dir> if given, otherwise the database)')
+            print('        (metrics look like disk./sastmp.usep, mem.used, cpu.all.busy)')
             print('    -c for CPU info')
             print('    -d for disk info')
             print('    -m for memory/swap info')
             print('    -n for network info')
             print('    -p to ping all known systems')
             print('    -s to check all services')
+            print('    -t for the top processes by CPU, memory and I/O')
             sys.exit(0)
 
-        if arg.startswith('-'):
-            sys.argv.append(arg)
-
-        # all the others:
-        if '-c' not in sys.argv:
-            fl_cpu = False
-            fl_ful = False
+        # all the others, we ignore any flags we don't know:
+        flags.append(arg)
 
-        if '-d' not in sys.argv:
-            fl_dsk = False
-            fl_ful = False
+    lclhost = socket.gethostname()
 
-        if '-m' not in sys.argv:
-            fl_mem = False
-            fl_ful = False
-
-        if '-n' not in sys.argv:
-            fl_net = False
-            fl_ful = False
-
-        if '-p' not in sys.argv:
-            fl_png = False
-            fl_ful = False
-
-        if '-s' not in sys.argv:
-            fl_svc = False
-            fl_ful = False
+    # somebody else collects it:
+    if aggregate != '':
+        agg = FleetAggregate(top_n)
+        inp = sys.stdin if aggregate == '-' else open(aggregate, 'r')
+        for record in json_records(inp):
+            try:
+                agg.add(record)
+            except (ValueError, KeyError, TypeError, AttributeError, IndexError) as error:
+                agg.add({'host': '?', 'ok': False, 'error': 'bad record: ' + str(error)})
 
-        # ignore any other flags we find, carry on
-        break
+        if fmt == 'text':
+            aggregate_print(agg.summary())
+        else:
+            print(json.dumps(agg.summary(), indent=2 if fmt == 'json' else None))
+        sys.exit(0)
 
-    broken = False
-    diag = Diag()
+    if fleet != '':
+        hosts = fleet_hosts(fleet)
+        if remote_cmd != '':
+            carrier = FLEET_TRANSPORTS[transport](remote_cmd)
+        else:
+            carrier = FLEET_TRANSPORTS[transport]()
 
-    lclhost = subprocess.check_output(['/usr/bin/hostname'], \
-            stderr=subprocess.STDOUT)
-    lclhost = lclhost.decode('utf-8')
-    lclhost = lclhost.rstrip() # single-line response needs rstrip()
+        started = time.time()
+        good, bad = asyncio.run(fleet_run(hosts, carrier, ['--format', 'json'] + flags, \
+                fleet_workers, fleet_timeout))
+        sys.stderr.write('{}: {} hosts, {} ok, {} failed in {:.1f}s\n'.format(iam, \
+                len(hosts), good, bad, time.time() - started))
+        sys.exit(0 if bad == 0 else 1)
 
-    if diag.sysname != lclhost:
-        # we can do better here with proper string formatting:
-        print("system_name entry '" + diag.sysname + \
-                "' not the same as '" + lclhost + "'")
-    else:
-        print('system:    ', diag.sysname)
-
-    print('OS version:', diag.os_version)
-    print('uptime:    ', diag.uptime)
-    print('date/time: ', diag.datestamp)
-    print()
+    if query != '':
+        try:
+            snap = socket_query(sock_path or DEFAULT_SOCKET, query, max_age)
+        except (IOError, OSError, ValueError) as error:
+            print(iam + ': query to', sock_path or DEFAULT_SOCKET, 'failed:', error)
+            sys.exit(1)
+        if fmt == 'ndjson':
+            print(json.dumps(snap, separators=(',', ':')))
+        else:
+            print(json.dumps(snap, indent=2))
+        sys.exit(0)
 
-    # only do these on a full output:
-    if fl_ful == True:
-        print('disk_count:', diag.disk_count)
-        print('network:   ', diag.net_interface)
-        print()
+    if shm_read_only:
+        try:
+            ts, snap = shm_read(shm_path)
+        except (IOError, OSError) as error:
+            print(iam + ':', error)
+            sys.exit(1)
+        if snap is None:
+            print(iam + ': nothing published in', shm_path, 'yet')
+            sys.exit(1)
+        if fmt == 'ndjson':
+            print(json.dumps(snap, separators=(',', ':')))
+        else:
+            print(json.dumps(snap, indent=2))
+        sys.exit(0)
 
-    if fl_dsk == True:
-        print('Disks:')
-        diag.disk_print()
-        print()
+    # answer from the history database, no collecting:
+    if history != '' and seg_dir != '':
+        segments_print(seg_dir, history, since)
+        sys.exit(0)
 
-    if fl_cpu == True:
-        print('CPU loads:')
-        diag.cpus_print()
-        print()
+    if history != '':
+        try:
+            store = HistoryStore(db_path or DEFAULT_DB, readonly=True)
+            history_print(store, history, lclhost, since)
+        except sqlite3.Error as error:
+            print(iam + ':', (db_path or DEFAULT_DB) + ':', error)
+            sys.exit(1)
+        store.close()
+        sys.exit(0)
+
+    # only collect what we're going to print, no flags means everything:
+    full = len(flags) == 0
+    wanted = []
+    for flag, name in [('-d', 'disks'), ('-c', 'cpus'), ('-m', 'memory'), \
+            ('-n', 'network'), ('-p', 'netping'), ('-s', 'services'), ('-t', 'procs')]:
+        if full or flag in flags:
+            wanted.append(name)
 
-    if fl_mem == True:
-        print('Memory and Swap space:')
-        diag.swapmem_print()
-        print()
+    broken = False
+    diag = Diag(wanted)
 
-    if fl_net == True:
-        print('Network info:')
-        diag.network_print()
-        print()
+    # a daemon gets stopped with SIGTERM, let it close its files too:
+    signal.signal(signal.SIGTERM, terminate)
 
-    if fl_png == True:
-        print('Sysping:', end=' ')
-        if len(diag.netping_lines) == 0:
-            print('OK')
-        else:
-            print()
-            for l in diag.netping_lines:
-                print(l)
-        print()
+    cache = None
+    if serve_addr != '' or sock_path != '' or shm_publish:
+        cache = SnapshotCache(diag, lclhost, wanted, min_refresh)
 
-    if fl_svc == True:
-        print('Services:')
-        svccount = len(diag.services)
-        running   = svccount
-        notrunning = 0
-
-        for svc in diag.services:
-            x = diag.services[svc]
-            if x[0] != 'active' or x[1] != '(running)':
-                print('    ' + svc + ':', diag.services[svc])
-                if not os.path.isfile("/var/run/sas" + svc):
-                    print('   !' + svc + ': pid file missing')
-                notrunning += 1
-
-        if notrunning == 0:
-            print('    all', str(running) + ' services are running')
-        else:
-            print()
-            if notrunning == 1:
-                print('    1 service is down')
-            else:
-                print('   ', notrunning, 'services are down')
+    if serve_addr != '':
+        serve(cache, serve_addr)
 
-            print('   ', running, 'services are running')
+    if sock_path != '':
+        try:
+            socket_serve(cache, sock_path)
+        except (IOError, OSError) as error:
+            print(iam + ':', error)
+            sys.exit(1)
+
+    # without --watch, just answer the servers:
+    if interval <= 0 and (serve_addr != '' or sock_path != ''):
+        g_keep_open = True
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            sys.exit(0)
 
-        print()
+    if interval > 0:
+        publisher = None
+        if shm_publish:
+            publisher = ShmPublisher(shm_path)
+
+        store = None
+        if db_path != '':
+            store = HistoryStore(db_path, diag.history_keep)
+        segments = None
+        if seg_dir != '':
+            segments = SegmentWriter(seg_dir)
+        try:
+            watch(diag, lclhost, wanted, full, interval, store, segments, fmt, \
+                    cache, publisher)
+        except KeyboardInterrupt:
+            if store is not None:
+                store.close()
+            if segments is not None:
+                segments.close()
+            sys.exit(0)
 
-    print()
+    output(diag, lclhost, wanted, full, fmt)
 
     """ use this when we want to examine the dictionaries:
     pp = pprint.PrettyPrinter(indent=4)